@@ -167,6 +167,47 @@ def sample_fpa_batch(args: DataloaderArgs, metadata: PickleableFPAMetadata,
     ...
 
 
+class FPAMetadataHandle:
+    def __init__(self, metadata: PickleableFPAMetadata) -> None:
+        ...
+
+    def set_premise_cache_size(self, max_size: int) -> None:
+        ...
+
+    def clear_premise_features(self) -> None:
+        ...
+
+
+def sample_fpa_with_handle(args: DataloaderArgs, metadata: FPAMetadataHandle,
+                           relevant_lemmas: List[str],
+                           prev_tactics: List[str],
+                           hypotheses: List[str],
+                           goal: str) -> \
+                           Tuple[
+                               List[List[List[int]]],
+                               List[List[List[float]]],
+                               List[int],
+                               List[List[int]],
+                               List[List[bool]],
+                               List[List[int]],
+                               List[List[float]]]:
+    ...
+
+
+def sample_fpa_batch_with_handle(args: DataloaderArgs,
+                                 metadata: FPAMetadataHandle,
+                                 context_batch: List[TacticContext]) -> \
+                                 Tuple[
+                                     List[List[List[int]]],
+                                     List[List[List[float]]],
+                                     List[int],
+                                     List[List[int]],
+                                     List[List[bool]],
+                                     List[List[int]],
+                                     List[List[float]]]:
+    ...
+
+
 def get_fpa_words(s: str) -> List[str]:
     ...
 
@@ -177,6 +218,27 @@ def decode_fpa_result(args: DataloaderArgs, metadata: PickleableFPAMetadata,
     ...
 
 
+def decode_fpa_result_with_handle(args: DataloaderArgs,
+                                  metadata: FPAMetadataHandle,
+                                  hyps: List[str], goal: str, tac_idx: int,
+                                  arg_idx: int) -> str:
+    ...
+
+
+def decode_fpa_results_with_handle(args: DataloaderArgs,
+                                   metadata: FPAMetadataHandle,
+                                   hyps: List[str], goal: str,
+                                   idxs: List[Tuple[int, int]],
+                                   k: int) -> List[Tuple[int, str]]:
+    ...
+
+
+def encode_fpa_stem_with_handle(args: DataloaderArgs,
+                                metadata: FPAMetadataHandle,
+                                tac_stem: str) -> int:
+    ...
+
+
 def features_vocab_sizes(tmap: TokenMap) -> Tuple[List[int], int]:
     ...
 
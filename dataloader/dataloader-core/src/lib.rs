@@ -137,7 +137,34 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         LongTensor2D,
         FloatTensor2D,
     ) {
-        sample_fpa_batch_rs(args, metadata, context_batch)
+        sample_fpa_batch_rs(
+            args,
+            &fpa_metadata_from_pickleable(metadata),
+            None,
+            context_batch,
+        )
+    }
+    #[pyfn(m)]
+    fn sample_fpa_batch_with_handle(
+        _py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        context_batch: Vec<TacticContext>,
+    ) -> (
+        LongUnpaddedTensor3D,
+        FloatUnpaddedTensor3D,
+        LongTensor1D,
+        LongTensor2D,
+        BoolTensor2D,
+        LongTensor2D,
+        FloatTensor2D,
+    ) {
+        sample_fpa_batch_rs(
+            args,
+            &metadata.metadata,
+            Some(&metadata.premise_cache),
+            context_batch,
+        )
     }
     #[pyfn(m)]
     fn sample_fpa(
@@ -159,7 +186,36 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     ) {
         sample_fpa_rs(
             args,
-            metadata,
+            &fpa_metadata_from_pickleable(metadata),
+            None,
+            relevant_lemmas,
+            prev_tactics,
+            hypotheses,
+            goal,
+        )
+    }
+    #[pyfn(m)]
+    fn sample_fpa_with_handle(
+        _py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        relevant_lemmas: Vec<String>,
+        prev_tactics: Vec<String>,
+        hypotheses: Vec<String>,
+        goal: String,
+    ) -> (
+        LongUnpaddedTensor3D,
+        FloatUnpaddedTensor3D,
+        LongTensor1D,
+        LongTensor2D,
+        BoolTensor2D,
+        LongTensor2D,
+        FloatTensor2D,
+    ) {
+        sample_fpa_rs(
+            args,
+            &metadata.metadata,
+            Some(&metadata.premise_cache),
             relevant_lemmas,
             prev_tactics,
             hypotheses,
@@ -176,7 +232,32 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         tac_idx: i64,
         arg_idx: i64,
     ) -> String {
-        decode_fpa_result_rs(args, metadata, hyps, goal, tac_idx, arg_idx)
+        decode_fpa_result_rs(args, &fpa_metadata_from_pickleable(metadata),
+                             hyps, goal, tac_idx, arg_idx)
+    }
+    #[pyfn(m)]
+    fn decode_fpa_result_with_handle(
+        _py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        hyps: Vec<String>,
+        goal: &str,
+        tac_idx: i64,
+        arg_idx: i64,
+    ) -> String {
+        decode_fpa_result_rs(args, &metadata.metadata, hyps, goal, tac_idx, arg_idx)
+    }
+    #[pyfn(m)]
+    fn decode_fpa_results_with_handle(
+        _py: Python,
+        args: DataloaderArgs,
+        metadata: &FPAMetadataHandle,
+        hyps: Vec<String>,
+        goal: &str,
+        idxs: Vec<(i64, i64)>,
+        k: usize,
+    ) -> Vec<(usize, String)> {
+        decode_fpa_results_rs(args, &metadata.metadata, hyps, goal, idxs, k)
     }
     #[pyfn(m)]
     fn tokenize(
@@ -184,7 +265,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         args: DataloaderArgs,
         metadata: PickleableFPAMetadata,
         term: String) -> LongTensor1D {
-        tokenize_fpa(args, metadata, term)
+        tokenize_fpa(args, &fpa_metadata_from_pickleable(metadata), term)
     }
     #[pyfn(m)]
     pub fn get_premise_features(
@@ -207,7 +288,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         metadata: PickleableFPAMetadata,
         tac_idx: i64,
     ) -> String {
-        decode_fpa_stem_rs(&args, metadata, tac_idx)
+        decode_fpa_stem_rs(&args, &fpa_metadata_from_pickleable(metadata), tac_idx)
     }
     #[pyfn(m)]
     fn encode_fpa_stem(
@@ -216,7 +297,16 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
         metadata: PickleableFPAMetadata,
         tac_stem: String,
     ) -> i64 {
-        encode_fpa_stem_rs(&args, metadata, tac_stem)
+        encode_fpa_stem_rs(&args, &mut fpa_metadata_from_pickleable(metadata), tac_stem)
+    }
+    #[pyfn(m)]
+    fn encode_fpa_stem_with_handle(
+        _py: Python,
+        args: DataloaderArgs,
+        mut metadata: PyRefMut<FPAMetadataHandle>,
+        tac_stem: String,
+    ) -> i64 {
+        encode_fpa_stem_rs(&args, &mut metadata.metadata, tac_stem)
     }
     #[pyfn(m)]
     fn decode_fpa_arg(
@@ -402,6 +492,7 @@ fn dataloader(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_class::<TokenMap>()?;
     m.add_class::<DataloaderArgs>()?;
     m.add_class::<GoalEncMetadata>()?;
+    m.add_class::<FPAMetadataHandle>()?;
     m.add_class::<ScrapedTactic>()?;
     m.add_class::<ProofContext>()?;
     m.add_class::<ScrapedTransition>()?;
@@ -6,7 +6,9 @@ use rand::Rng;
 use rayon::prelude::*;
 use regex::Regex;
 use serde::{Deserialize, Serialize};
+use std::collections::{HashMap, HashSet};
 use std::fs::File;
+use std::sync::Mutex;
 
 use crate::context_filter::{parse_filter, apply_filter};
 use crate::features::PickleableTokenMap as PickleableFeaturesTokenMap;
@@ -66,6 +68,181 @@ pub fn fpa_metadata_from_pickleable(pick: PickleableFPAMetadata) -> FPAMetadata
     )
 }
 
+// Rebuilding the indexer, tokenizer, and token map from their pickleable
+// forms is a lot of hashing, so at inference time the predictor builds them
+// once into one of these, and passes it to the dataloader by reference.
+#[pyclass(module = "dataloader")]
+pub struct FPAMetadataHandle {
+    pub metadata: FPAMetadata,
+    pub premise_cache: Mutex<PremiseCache>,
+}
+
+#[pymethods]
+impl FPAMetadataHandle {
+    #[new]
+    fn new(metadata: PickleableFPAMetadata) -> Self {
+        FPAMetadataHandle {
+            metadata: fpa_metadata_from_pickleable(metadata),
+            premise_cache: Mutex::new(PremiseCache::default()),
+        }
+    }
+    fn set_premise_cache_size(&self, max_size: usize) {
+        let mut cache = self.premise_cache.lock().unwrap();
+        cache.max_size = max_size;
+        cache.tokenized.clear();
+        cache.features.clear();
+        cache.num_features = 0;
+    }
+    // The tokenized premises don't depend on the goal, so they're kept
+    // across lemmas; only the features comparing premises to goals go.
+    fn clear_premise_features(&self) {
+        let mut cache = self.premise_cache.lock().unwrap();
+        cache.features.clear();
+        cache.num_features = 0;
+    }
+}
+
+// Tokenizing the premises of a context, and comparing each of them to the
+// goal, is most of the work of featurizing it at inference time. But during
+// a search the same premises come up in context after context, and the same
+// goals come up again and again, so the handle remembers the tokenized
+// premises by their text, and their features by the goal and the premise.
+// Either map is emptied when it would grow past max_size entries; a
+// max_size of zero turns the cache off.
+type CachedPremise = (Option<LongTensor1D>, Option<FloatTensor1D>);
+
+#[derive(Default)]
+pub struct PremiseCache {
+    max_size: usize,
+    tokenized: HashMap<String, LongTensor1D>,
+    features: HashMap<String, HashMap<String, FloatTensor1D>>,
+    num_features: usize,
+}
+
+impl PremiseCache {
+    fn lookup(&self, premises: &Vec<String>, goal: &str) -> Vec<CachedPremise> {
+        let goal_features = self.features.get(goal);
+        premises
+            .iter()
+            .map(|premise| {
+                (
+                    self.tokenized.get(premise).cloned(),
+                    goal_features.and_then(|fs| fs.get(premise).cloned()),
+                )
+            })
+            .collect()
+    }
+    fn insert(
+        &mut self,
+        premises: &Vec<String>,
+        goal: &str,
+        tokenized_premises: &Vec<LongTensor1D>,
+        premise_features: &Vec<FloatTensor1D>,
+    ) {
+        if self.max_size == 0 {
+            return;
+        }
+        for (premise, tokens) in premises.iter().zip(tokenized_premises) {
+            if !self.tokenized.contains_key(premise) {
+                if self.tokenized.len() >= self.max_size {
+                    self.tokenized.clear();
+                }
+                self.tokenized.insert(premise.clone(), tokens.clone());
+            }
+        }
+        if self.num_features + premises.len() > self.max_size {
+            self.features.clear();
+            self.num_features = 0;
+        }
+        let goal_features = self
+            .features
+            .entry(goal.to_string())
+            .or_insert_with(HashMap::new);
+        for (premise, features) in premises.iter().zip(premise_features) {
+            if !goal_features.contains_key(premise) {
+                goal_features.insert(premise.clone(), features.clone());
+                self.num_features += 1;
+            }
+        }
+    }
+}
+
+// Tokenizes the premises of each context, and computes their features
+// against its goal, reusing whatever the cache already has.
+fn premise_tensors(
+    args: &DataloaderArgs,
+    tokenizer: &Tokenizer,
+    premises_batch: &Vec<Vec<String>>,
+    goals: &Vec<&String>,
+    premise_cache: Option<&Mutex<PremiseCache>>,
+) -> (LongUnpaddedTensor3D, FloatUnpaddedTensor3D) {
+    let cached_batch: Vec<Vec<CachedPremise>> = match premise_cache {
+        Some(cache) => {
+            let cache = cache.lock().unwrap();
+            premises_batch
+                .iter()
+                .zip(goals.iter())
+                .map(|(premises, goal)| cache.lookup(premises, goal))
+                .collect()
+        }
+        None => premises_batch
+            .iter()
+            .map(|premises| premises.iter().map(|_| (None, None)).collect())
+            .collect(),
+    };
+    let (tprems_batch, premise_features_batch): (LongUnpaddedTensor3D, FloatUnpaddedTensor3D) =
+        premises_batch
+            .par_iter()
+            .zip(goals.par_iter())
+            .zip(cached_batch.into_par_iter())
+            .map(|((premises, goal), cached)| {
+                featurize_premises(args, tokenizer, premises, goal, cached)
+            })
+            .unzip();
+    if let Some(cache) = premise_cache {
+        let mut cache = cache.lock().unwrap();
+        for (((premises, goal), tprems), features) in premises_batch
+            .iter()
+            .zip(goals.iter())
+            .zip(tprems_batch.iter())
+            .zip(premise_features_batch.iter())
+        {
+            cache.insert(premises, goal, tprems, features);
+        }
+    }
+    (tprems_batch, premise_features_batch)
+}
+
+fn featurize_premises(
+    args: &DataloaderArgs,
+    tokenizer: &Tokenizer,
+    premises: &Vec<String>,
+    goal: &str,
+    cached: Vec<CachedPremise>,
+) -> (Vec<LongTensor1D>, Vec<FloatTensor1D>) {
+    premises
+        .iter()
+        .zip(cached.into_iter())
+        .map(|(premise, (tokens, features))| {
+            (
+                tokens.unwrap_or_else(|| {
+                    normalize_sentence_length(
+                        tokenizer.tokenize(get_hyp_type(premise)),
+                        args.max_length,
+                        0,
+                    )
+                }),
+                features.unwrap_or_else(|| {
+                    vec![
+                        gestalt_ratio(goal, get_hyp_type(premise)),
+                        equality_hyp_feature(premise, goal),
+                    ]
+                }),
+            )
+        })
+        .unzip()
+}
+
 pub fn features_polyarg_tensors_rs(
     args: DataloaderArgs,
     filename: String,
@@ -278,10 +455,10 @@ fn get_goal_mask(goal: &str, max_length: usize) -> Vec<bool> {
 
 pub fn tokenize_fpa(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     term: String) -> LongTensor1D {
 
-    let (_indexer, tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
+    let (_indexer, tokenizer, _ftmap) = metadata;
     normalize_sentence_length(
         tokenizer.tokenize(&term),
         args.max_length, 0)
@@ -304,7 +481,8 @@ pub fn get_premise_features_size_rs(
 
 pub fn sample_fpa_batch_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
+    premise_cache: Option<&Mutex<PremiseCache>>,
     context_batch: Vec<TacticContext>,
 ) -> (
     LongUnpaddedTensor3D,
@@ -315,13 +493,13 @@ pub fn sample_fpa_batch_rs(
     LongTensor2D,
     FloatTensor2D,
 ) {
-    let (_indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+    let (_indexer, tokenizer, ftmap) = metadata;
     let (word_features_batch, vec_features_batch) = context_batch
         .iter()
         .map(|ctxt| {
             sample_context_features_rs(
                 &args,
-                &ftmap,
+                ftmap,
                 &ctxt.relevant_lemmas,
                 &ctxt.prev_tactics,
                 &ctxt.obligation.hypotheses,
@@ -342,26 +520,12 @@ pub fn sample_fpa_batch_rs(
         })
         .collect();
 
-    let premise_scores_batch: Vec<Vec<f64>> = premises_batch
-        .par_iter()
-        .zip(context_batch.par_iter())
-        .map(|(premises, context)| score_hyps(premises, &context.obligation.goal))
-        .collect();
-
-    let premise_features_batch = premises_batch
-        .par_iter()
-        .zip(premise_scores_batch.par_iter())
-        .zip(context_batch.par_iter())
-        .map(|((premises, scores), ctxt)| {
-            premises
-                .iter()
-                .zip(scores.iter())
-                .map(|(premise, score)| {
-                    vec![*score, equality_hyp_feature(premise, &ctxt.obligation.goal)]
-                })
-                .collect()
-        })
+    let goals: Vec<&String> = context_batch
+        .iter()
+        .map(|ctxt| &ctxt.obligation.goal)
         .collect();
+    let (tprems_batch, premise_features_batch) =
+        premise_tensors(&args, tokenizer, &premises_batch, &goals, premise_cache);
 
     let tgoals_batch = context_batch
         .par_iter()
@@ -377,22 +541,6 @@ pub fn sample_fpa_batch_rs(
         .par_iter()
         .map(|ctxt| get_goal_mask(&ctxt.obligation.goal, args.max_length))
         .collect();
-    let tprems_batch: Vec<Vec<Vec<i64>>> = premises_batch
-        .into_iter()
-        .map(|premises| {
-            premises
-                .into_iter()
-                .map(|premise| {
-                    normalize_sentence_length(
-                        tokenizer.tokenize(get_hyp_type(&premise)),
-                        args.max_length,
-                        0,
-                    )
-                })
-                .collect()
-        })
-        .collect();
-
     let num_hyps_batch = tprems_batch
         .iter()
         .map(|tprems| tprems.len() as i64)
@@ -411,7 +559,8 @@ pub fn sample_fpa_batch_rs(
 
 pub fn sample_fpa_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
+    premise_cache: Option<&Mutex<PremiseCache>>,
     relevant_lemmas: Vec<String>,
     prev_tactics: Vec<String>,
     hypotheses: Vec<String>,
@@ -425,10 +574,10 @@ pub fn sample_fpa_rs(
     LongTensor2D,
     FloatTensor2D,
 ) {
-    let (_indexer, tokenizer, ftmap) = fpa_metadata_from_pickleable(metadata);
+    let (_indexer, tokenizer, ftmap) = metadata;
     let (word_features, vec_features) = sample_context_features_rs(
         &args,
-        &ftmap,
+        ftmap,
         &relevant_lemmas,
         &prev_tactics,
         &hypotheses,
@@ -438,26 +587,19 @@ pub fn sample_fpa_rs(
         .into_iter()
         .chain(relevant_lemmas.into_iter())
         .collect();
-    let premise_scores = score_hyps(&all_premises, &goal);
-    let premise_features = all_premises
-        .iter()
-        .zip(premise_scores.iter())
-        .map(|(premise, score)| vec![*score, equality_hyp_feature(premise, &goal)])
-        .collect();
+    let (mut tprems_batch, mut premise_features_batch) = premise_tensors(
+        &args,
+        tokenizer,
+        &vec![all_premises],
+        &vec![&goal],
+        premise_cache,
+    );
+    let tokenized_premises = tprems_batch.pop().unwrap();
+    let premise_features = premise_features_batch.pop().unwrap();
     let tokenized_goal = normalize_sentence_length(tokenizer.tokenize(&goal), args.max_length, 0);
 
     let goal_symbols_mask = get_goal_mask(&goal, args.max_length);
 
-    let tokenized_premises: Vec<Vec<i64>> = all_premises
-        .into_iter()
-        .map(|premise| {
-            normalize_sentence_length(
-                tokenizer.tokenize(get_hyp_type(&premise)),
-                args.max_length,
-                0,
-            )
-        })
-        .collect();
     let num_hyps = tokenized_premises.len();
     (
         vec![tokenized_premises],
@@ -472,7 +614,7 @@ pub fn sample_fpa_rs(
 
 pub fn decode_fpa_result_rs(
     args: DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     premises: Vec<String>,
     goal: &str,
     tac_idx: i64,
@@ -480,6 +622,10 @@ pub fn decode_fpa_result_rs(
 ) -> String {
     let stem = decode_fpa_stem_rs(&args, metadata, tac_idx);
     let arg = decode_fpa_arg_rs(&args, premises, goal, arg_idx);
+    format_fpa_result(&stem, &arg)
+}
+
+fn format_fpa_result(stem: &str, arg: &str) -> String {
     if arg == "" {
         format!("{}.", stem)
     } else {
@@ -487,21 +633,49 @@ pub fn decode_fpa_result_rs(
     }
 }
 
+// Decodes (stem, arg) index pairs in order until k distinct tactics have
+// been found, returning each one with the position of the pair it came
+// from. The goal is only split into words once for all the pairs.
+pub fn decode_fpa_results_rs(
+    args: DataloaderArgs,
+    metadata: &FPAMetadata,
+    premises: Vec<String>,
+    goal: &str,
+    idxs: Vec<(i64, i64)>,
+    k: usize,
+) -> Vec<(usize, String)> {
+    let goal_words = get_words(goal);
+    let mut seen = HashSet::new();
+    let mut results = Vec::new();
+    for (i, (tac_idx, arg_idx)) in idxs.into_iter().enumerate() {
+        if results.len() >= k {
+            break;
+        }
+        let stem = decode_fpa_stem_rs(&args, metadata, tac_idx);
+        let arg = decode_fpa_arg_from_words(&args, &premises, &goal_words, arg_idx);
+        let tactic = format_fpa_result(&stem, &arg);
+        if seen.insert(tactic.clone()) {
+            results.push((i, tactic));
+        }
+    }
+    results
+}
+
 pub fn decode_fpa_stem_rs(
     _args: &DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &FPAMetadata,
     tac_idx: i64,
 ) -> String {
-    let (indexer, _tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
+    let (indexer, _tokenizer, _ftmap) = metadata;
     indexer.reverse_lookup(tac_idx)
 }
 
 pub fn encode_fpa_stem_rs(
     _args: &DataloaderArgs,
-    metadata: PickleableFPAMetadata,
+    metadata: &mut FPAMetadata,
     tac_stem: String,
 ) -> i64 {
-    let (mut indexer, _tokenizer, _ftmap) = fpa_metadata_from_pickleable(metadata);
+    let (indexer, _tokenizer, _ftmap) = metadata;
     indexer.lookup(tac_stem)
 }
 
@@ -510,6 +684,15 @@ pub fn decode_fpa_arg_rs(
     premises: Vec<String>,
     goal: &str,
     arg_idx: i64,
+) -> String {
+    decode_fpa_arg_from_words(args, &premises, &get_words(goal), arg_idx)
+}
+
+fn decode_fpa_arg_from_words(
+    args: &DataloaderArgs,
+    premises: &[String],
+    goal_words: &[&str],
+    arg_idx: i64,
 ) -> String {
     let argtype = if arg_idx == 0 {
         TacticArgument::NoArg
@@ -523,10 +706,10 @@ pub fn decode_fpa_arg_rs(
         TacticArgument::Unrecognized => "".to_string(),
         TacticArgument::GoalToken(tidx) => {
             // assert!(tidx < get_words(goal).len(), format!("{}, {:?}, {}", goal, get_words(goal), tidx));
-            if tidx >= get_words(goal).len() {
+            if tidx >= goal_words.len() {
                 "<INVALID>".to_string()
             } else {
-                get_words(goal)[tidx].to_string()
+                goal_words[tidx].to_string()
             }
         }
         TacticArgument::HypVar(hidx) => {
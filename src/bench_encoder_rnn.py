@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Checks that EncoderRNN, which runs its GRU over the whole sequence at once,
+# computes the same thing as the old token-at-a-time loop, and times the two.
+
+import argparse
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.components import EncoderRNN
+from util import maybe_cuda, use_cuda
+
+
+def loop_forward(encoder: EncoderRNN,
+                 input_seq: torch.LongTensor) -> torch.FloatTensor:
+    # The original EncoderRNN.forward, with the same weights
+    batch_size = input_seq.size()[0]
+    hidden = maybe_cuda(torch.zeros(1, batch_size, encoder.hidden_size))
+    for i in range(input_seq.size()[1]):
+        token_batch = encoder._word_embedding(input_seq[:, i])\
+            .view(1, batch_size, encoder.hidden_size)
+        token_batch = F.relu(token_batch)
+        token_out, hidden = encoder._gru(token_batch, hidden)
+    return encoder._out_layer(token_out.view(batch_size, encoder.hidden_size))
+
+
+def time_forward(forward, iterations: int) -> float:
+    forward()
+    if use_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        forward()
+    if use_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the whole-sequence EncoderRNN against the "
+        "token-at-a-time loop it replaced")
+    parser.add_argument("--vocab-size", type=int, default=512)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--max-length", type=int, default=30)
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 16, 256])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    encoder = EncoderRNN(args.vocab_size, args.hidden_size, args.hidden_size)
+    encoder.eval()
+    # The weights should carry over between the implementations unchanged
+    reloaded = EncoderRNN(args.vocab_size, args.hidden_size, args.hidden_size)
+    reloaded.load_state_dict(encoder.state_dict())
+    reloaded.eval()
+
+    all_match = True
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            input_seq = maybe_cuda(torch.randint(
+                args.vocab_size, (batch_size, args.max_length)))
+            expected = loop_forward(encoder, input_seq)
+            actual = reloaded(input_seq)
+            max_diff = (expected - actual).abs().max().item()
+            matches = max_diff <= args.tolerance
+            all_match = all_match and matches
+            loop_time = time_forward(
+                lambda: loop_forward(encoder, input_seq), args.iterations)
+            seq_time = time_forward(
+                lambda: reloaded(input_seq), args.iterations)
+            print(f"batch size {batch_size}: "
+                  f"max difference {max_diff:.2e} "
+                  f"({'ok' if matches else 'MISMATCH'}), "
+                  f"loop {loop_time * 1000:.2f}ms, "
+                  f"whole sequence {seq_time * 1000:.2f}ms, "
+                  f"speedup {loop_time / seq_time:.1f}x")
+    if not all_match:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
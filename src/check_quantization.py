@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import torch
+from tqdm import tqdm
+
+import dataloader
+import predict_tactic
+import util
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import TacticPredictor
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the predictions of a quantized predictor "
+        "against the float one it came from, on held-out scrape files, to "
+        "check whether --quantize is safe to use for search")
+    parser.add_argument("weightsfile", type=Path)
+    parser.add_argument("scrape_files", nargs="+", type=Path)
+    parser.add_argument("--num-predictions", default=16, type=int)
+    parser.add_argument("--batch-size", default=32, type=int)
+    parser.add_argument("--max-points", default=None, type=int)
+    args = parser.parse_args()
+    check_quantization(args)
+
+
+def check_quantization(args: argparse.Namespace) -> None:
+    util.use_cuda = False
+    float_predictor = predict_tactic.loadPredictorByFile(args.weightsfile)
+    quantized_predictor = predict_tactic.loadPredictorByFile(args.weightsfile)
+    if not quantized_predictor.can_quantize():
+        util.eprint(f"Can't quantize the predictor in {args.weightsfile}; "
+                    "only uncompiled polyarg predictors can be quantized")
+        sys.exit(1)
+    quantized_predictor.quantize()
+
+    contexts: List[TacticContext] = []
+    tactics: List[str] = []
+    for filename in args.scrape_files:
+        for point in dataloader.scraped_tactics_from_file(str(filename),
+                                                          None):
+            if len(point.context.fg_goals) == 0:
+                continue
+            contexts.append(TacticContext(point.relevant_lemmas,
+                                          point.prev_tactics,
+                                          point.context.fg_goals[0].hypotheses,
+                                          point.context.fg_goals[0].goal))
+            tactics.append(point.tactic.strip())
+    if args.max_points is not None:
+        contexts = contexts[:args.max_points]
+        tactics = tactics[:args.max_points]
+    if len(contexts) == 0:
+        print("No proof contexts with a focused goal in the given scrape "
+              "files, so there is nothing to compare")
+        sys.exit(1)
+
+    float_predictions, float_time = predict_all(
+        float_predictor, contexts, args, "Float predictions")
+    quantized_predictions, quantized_time = predict_all(
+        quantized_predictor, contexts, args, "Quantized predictions")
+
+    num_total = len(contexts)
+    num_top1_agree = 0
+    total_overlap = 0.0
+    num_float_correct = 0
+    num_quantized_correct = 0
+    for float_preds, quantized_preds, tactic in \
+            zip(float_predictions, quantized_predictions, tactics):
+        if float_preds[:1] == quantized_preds[:1]:
+            num_top1_agree += 1
+        if float_preds:
+            total_overlap += len(set(float_preds) & set(quantized_preds)) / \
+                len(float_preds)
+        if tactic in float_preds:
+            num_float_correct += 1
+        if tactic in quantized_preds:
+            num_quantized_correct += 1
+
+    print(f"num_total: {num_total}")
+    print(f"top-1 agreement: {num_top1_agree / num_total:.2%}")
+    print(f"top-{args.num_predictions} overlap: "
+          f"{total_overlap / num_total:.2%}")
+    print(f"float correct in top-{args.num_predictions}: "
+          f"{num_float_correct / num_total:.2%}")
+    print(f"quantized correct in top-{args.num_predictions}: "
+          f"{num_quantized_correct / num_total:.2%}")
+    print(f"float time: {float_time:.2f}s")
+    print(f"quantized time: {quantized_time:.2f}s "
+          f"({float_time / quantized_time:.2f}x speedup)")
+
+
+def predict_all(predictor: TacticPredictor, contexts: List[TacticContext],
+                args: argparse.Namespace, desc: str) \
+        -> Tuple[List[List[str]], float]:
+    predictions: List[List[str]] = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch_start in tqdm(range(0, len(contexts), args.batch_size),
+                                desc=desc):
+            predictions += [
+                [p.prediction for p in batch_predictions]
+                for batch_predictions in predictor.predictKTactics_batch(
+                    contexts[batch_start:batch_start + args.batch_size],
+                    args.num_predictions)]
+    return predictions, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
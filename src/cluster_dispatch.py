@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import sys
+from abc import ABCMeta, abstractmethod
+from pathlib import Path
+from typing import List, Dict, Optional
+
+cur_dir = os.path.realpath(os.path.dirname(__file__))
+
+
+class Dispatcher(metaclass=ABCMeta):
+    # Runs array jobs for cluster mode. Each task in the array runs a script
+    # from this directory, and gets its index in the SLURM_ARRAY_TASK_ID
+    # environment variable. Task output goes to output_pattern, with %a
+    # replaced by the task index.
+    @abstractmethod
+    def dispatch(self, script: str, script_args: List[str], num_tasks: int,
+                 output_pattern: Path, job_name: Optional[str] = None,
+                 num_cpus: Optional[int] = None,
+                 partition: Optional[str] = None,
+                 timeout: Optional[str] = None,
+                 mem: Optional[str] = None) -> None:
+        pass
+
+    @abstractmethod
+    def cancel(self, job_name: Optional[str]) -> None:
+        pass
+
+
+class SlurmDispatcher(Dispatcher):
+    def dispatch(self, script: str, script_args: List[str], num_tasks: int,
+                 output_pattern: Path, job_name: Optional[str] = None,
+                 num_cpus: Optional[int] = None,
+                 partition: Optional[str] = None,
+                 timeout: Optional[str] = None,
+                 mem: Optional[str] = None) -> None:
+        sbatch_args = ["-o", str(output_pattern),
+                       f"--array=0-{num_tasks-1}"]
+        if job_name:
+            sbatch_args += ["-J", job_name]
+        if partition:
+            sbatch_args += ["-p", partition]
+        if timeout:
+            sbatch_args += ["-t", timeout]
+        if num_cpus:
+            sbatch_args += ["--cpus-per-task", str(num_cpus)]
+        if mem:
+            sbatch_args += ["--mem", mem]
+        # If you have a different cluster management software, that still
+        # allows dispatching jobs through the command line and uses a shared
+        # filesystem, write a Dispatcher for it like this one.
+        subprocess.run([f"{cur_dir}/sbatch-retry.sh"] + sbatch_args +
+                       [f"{cur_dir}/{script}.sh"] + script_args)
+
+    def cancel(self, job_name: Optional[str]) -> None:
+        subprocess.run([f"scancel -u $USER -n {job_name}"], shell=True)
+
+
+class LocalDispatcher(Dispatcher):
+    # Runs the array tasks as processes on this machine, so cluster mode can
+    # be tried out (and its overheads measured) without a cluster. The tasks
+    # run in the current environment, so set up the opam switch first.
+    def __init__(self) -> None:
+        self.processes: Dict[Optional[str], List[subprocess.Popen]] = {}
+
+    def dispatch(self, script: str, script_args: List[str], num_tasks: int,
+                 output_pattern: Path, job_name: Optional[str] = None,
+                 num_cpus: Optional[int] = None,
+                 partition: Optional[str] = None,
+                 timeout: Optional[str] = None,
+                 mem: Optional[str] = None) -> None:
+        for task_idx in range(num_tasks):
+            output_file = Path(str(output_pattern).replace("%a",
+                                                           str(task_idx)))
+            with output_file.open('w') as out:
+                self.processes.setdefault(job_name, []).append(
+                    subprocess.Popen(
+                        [sys.executable, f"{cur_dir}/{script}.py"] +
+                        script_args,
+                        stdout=out, stderr=subprocess.STDOUT,
+                        env=dict(os.environ,
+                                 SLURM_ARRAY_TASK_ID=str(task_idx))))
+
+    def cancel(self, job_name: Optional[str]) -> None:
+        processes = self.processes.pop(job_name, [])
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def get_dispatcher(args: argparse.Namespace) -> Dispatcher:
+    if args.dispatcher == "slurm":
+        return SlurmDispatcher()
+    elif args.dispatcher == "local":
+        return LocalDispatcher()
+    else:
+        assert False, args.dispatcher
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+import multiprocessing
+import multiprocessing.connection
+import queue
+import time
+import traceback
+from typing import List, NamedTuple, Optional, Tuple, Dict, Union
+
+import torch
+
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import Prediction, TacticPredictor
+import util
+from util import eprint
+
+
+class InferenceRequest(NamedTuple):
+    worker_idx: int
+    # Numbers each worker's requests, so a response that arrives after its
+    # worker gave up on it isn't taken as the answer to a later one.
+    seq: int
+    contexts: List[TacticContext]
+    k: int
+
+
+class ClearCachesRequest(NamedTuple):
+    worker_idx: int
+
+
+ServerRequest = Union[InferenceRequest, ClearCachesRequest]
+# The sequence number of the request, and its predictions or what went wrong
+InferenceResponse = Tuple[int, Union[List[List[Prediction]], Exception]]
+
+
+class RemotePredictor(TacticPredictor):
+    # Stands in for a predictor in a search worker, sending every prediction
+    # to an inference server process and waiting for the answer.
+    #
+    # The server holds the only write end of server_alive and never writes
+    # to it, so it reads as closed once the server process is gone, however
+    # it died. While waiting for an answer, the worker checks on it every
+    # poll_interval seconds, and gives up after response_timeout.
+    def __init__(self, worker_idx: int,
+                 requests: 'multiprocessing.Queue[Optional[ServerRequest]]',
+                 responses: 'multiprocessing.Queue[InferenceResponse]',
+                 server_alive: multiprocessing.connection.Connection,
+                 response_timeout: float = 600,
+                 poll_interval: float = 5) -> None:
+        super().__init__()
+        self.worker_idx = worker_idx
+        self.next_seq = 0
+        self.requests = requests
+        self.responses = responses
+        self.server_alive = server_alive
+        self.response_timeout = response_timeout
+        self.poll_interval = poll_interval
+        self.training_args = None
+        self.unparsed_args = []
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return [("predictor", "remote")]
+
+    def clear_caches(self) -> None:
+        self.requests.put(ClearCachesRequest(self.worker_idx))
+
+    def predictKTactics(self, in_data: TacticContext, k: int) \
+            -> List[Prediction]:
+        return self.predictKTactics_batch([in_data], k)[0]
+
+    def predictKTactics_batch(self, in_datas: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        seq = self.next_seq
+        self.next_seq += 1
+        self.requests.put(InferenceRequest(self.worker_idx, seq, in_datas, k))
+        deadline = time.time() + self.response_timeout
+        while True:
+            try:
+                response_seq, response = self.responses.get(timeout=min(
+                    self.poll_interval, max(deadline - time.time(), 0)))
+                if response_seq == seq:
+                    break
+                # A late answer to a request we already gave up on
+                continue
+            except queue.Empty:
+                pass
+            if self.server_alive.poll():
+                raise RuntimeError("The inference server died")
+            if time.time() >= deadline:
+                raise TimeoutError(
+                    f"The inference server didn't answer within "
+                    f"{self.response_timeout} seconds")
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) \
+            -> Tuple[List[Prediction], float]:
+        return self.predictKTactics(in_data, k), 0
+
+    def predictKTacticsWithLoss_batch(self, in_data: List[TacticContext],
+                                      k: int, correct: List[str]) \
+            -> Tuple[List[List[Prediction]], float]:
+        return self.predictKTactics_batch(in_data, k), 0
+
+
+def inference_server(predictor: TacticPredictor,
+                     device: str,
+                     requests: 'multiprocessing.Queue[Optional[ServerRequest]]',
+                     responses: 'List[multiprocessing.Queue[InferenceResponse]]',
+                     batch_window: float,
+                     max_batch_size: int,
+                     alive: multiprocessing.connection.Connection) -> None:
+    # alive is never written to; holding it open is what tells the workers
+    # this process is still running.
+    if util.use_cuda:
+        torch.cuda.set_device(device) # type: ignore
+    util.cuda_device = device
+    finished = False
+    while not finished:
+        first_request = requests.get()
+        if first_request is None:
+            return
+        # Caches are only there to save work, so clearing them can happen
+        # as soon as any worker asks, ahead of predictions already queued.
+        if isinstance(first_request, ClearCachesRequest):
+            predictor.clear_caches()
+            continue
+        # Gather up whatever other requests come in within the batch window,
+        # so they can all go through the model together.
+        batch: List[InferenceRequest] = [first_request]
+        batch_deadline = time.time() + batch_window
+        while sum(len(request.contexts) for request in batch) < max_batch_size:
+            time_left = batch_deadline - time.time()
+            if time_left <= 0:
+                break
+            try:
+                next_request = requests.get(timeout=time_left)
+            except queue.Empty:
+                break
+            if next_request is None:
+                finished = True
+                break
+            if isinstance(next_request, ClearCachesRequest):
+                predictor.clear_caches()
+                continue
+            batch.append(next_request)
+
+        requests_by_k: Dict[int, List[InferenceRequest]] = {}
+        for request in batch:
+            requests_by_k.setdefault(request.k, []).append(request)
+        for k, k_requests in requests_by_k.items():
+            try:
+                predictions = predictor.predictKTactics_batch(
+                    [context for request in k_requests
+                     for context in request.contexts], k)
+            except Exception as e:
+                eprint("Inference server failed to predict:")
+                traceback.print_exc()
+                for request in k_requests:
+                    responses[request.worker_idx].put((request.seq, e))
+                continue
+            next_prediction_idx = 0
+            for request in k_requests:
+                responses[request.worker_idx].put(
+                    (request.seq,
+                     predictions[next_prediction_idx:
+                                 next_prediction_idx + len(request.contexts)]))
+                next_prediction_idx += len(request.contexts)
+
+
+def start_inference_server(predictor: TacticPredictor,
+                           device: str,
+                           num_workers: int,
+                           batch_window: float,
+                           max_batch_size: int) \
+        -> Tuple[multiprocessing.Process, List[RemotePredictor]]:
+    requests: 'multiprocessing.Queue[Optional[ServerRequest]]' = \
+        multiprocessing.Queue()
+    responses: 'List[multiprocessing.Queue[InferenceResponse]]' = \
+        [multiprocessing.Queue() for _ in range(num_workers)]
+    server_alive, alive = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=inference_server,
+                                     args=(predictor, device, requests,
+                                           responses, batch_window,
+                                           max_batch_size, alive))
+    server.start()
+    # Only the server should hold the write end, so that it closes when the
+    # server exits
+    alive.close()
+    return server, [RemotePredictor(widx, requests, responses[widx],
+                                    server_alive)
+                    for widx in range(num_workers)]
+
+
+def stop_inference_server(server: multiprocessing.Process,
+                          remote_predictors: List[RemotePredictor]) -> None:
+    remote_predictors[0].requests.put(None)
+    server.join()
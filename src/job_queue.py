@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Set, Tuple
+
+from util import eprint
+
+
+class JobQueue:
+    # A queue of jobs on a shared filesystem, that any number of cluster
+    # workers can take jobs from without a global lock.
+    #
+    # The jobs are the lines of jobs.txt. A worker claims job i by creating
+    # claims/i with O_EXCL, which only one worker can do, and marks it
+    # finished by creating done/i. Each worker keeps a cursor into the jobs,
+    # so claiming only ever looks at jobs that weren't claimed the last time
+    # it looked. The cursors start spread out over the jobs, one per worker,
+    # and wrap around, so workers don't all race for the same claims.
+    #
+    # From claiming a job until marking it done, the queue keeps touching
+    # its claim file in the background, as long as the queue is open. When
+    # every job has been claimed, workers look for claims that haven't been
+    # touched in lease_time seconds and aren't done, and take them over, so
+    # jobs taken by workers that crashed or got killed are run again. Each
+    # look lists the done jobs once, and then goes through the rest over as
+    # many calls to claim as it takes; the done directory is only listed
+    # again, and claims checked again, every steal_scan_interval seconds.
+    def __init__(self, queue_dir: Path, lease_time: float = 600,
+                 worker_idx: int = 0, num_workers: int = 1) -> None:
+        self.queue_dir = queue_dir
+        self.lease_time = lease_time
+        self.claims_dir = queue_dir / "claims"
+        self.done_dir = queue_dir / "done"
+        with (queue_dir / "jobs.txt").open('r') as f:
+            self.jobs = [json.loads(line) for line in f]
+        self.start_idx = worker_idx * len(self.jobs) // num_workers
+        self.num_scanned = 0
+        self.done_jobs: Set[int] = set()
+        # The jobs left to check for expired claims from the last look,
+        # last one first
+        self.steal_candidates: List[int] = []
+        self.last_steal_scan: Optional[float] = None
+        self.steal_scan_interval = lease_time / 3
+        self.worker_name = f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_keeper = LeaseKeeper(lease_time / 3)
+
+    def __enter__(self) -> 'JobQueue':
+        self.lease_keeper.start()
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.lease_keeper.stop()
+
+    @staticmethod
+    def setup(queue_dir: Path, jobs: List[Any]) -> None:
+        for subdir in ["claims", "done"]:
+            shutil.rmtree(queue_dir / subdir, ignore_errors=True)
+            os.makedirs(queue_dir / subdir)
+        with (queue_dir / "jobs.txt").open("w") as f:
+            for job in jobs:
+                print(json.dumps(job), file=f)
+
+    def _try_claim(self, job_idx: int) -> bool:
+        try:
+            fd = os.open(self.claims_dir / str(job_idx),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            print(self.worker_name, file=f)
+        return True
+
+    def _try_steal(self, job_idx: int) -> bool:
+        claim_file = self.claims_dir / str(job_idx)
+        try:
+            if time.time() - claim_file.stat().st_mtime < self.lease_time:
+                return False
+            # Renaming is atomic, so only one worker gets to remove an
+            # expired claim, and then it has to claim the job like normal.
+            os.rename(claim_file,
+                      self.claims_dir / f"{job_idx}.expired-{self.worker_name}")
+        except FileNotFoundError:
+            return False
+        eprint(f"Reclaiming job {self.jobs[job_idx]} after its lease expired")
+        return self._try_claim(job_idx)
+
+    def claim(self) -> Optional[Tuple[int, Any]]:
+        while self.num_scanned < len(self.jobs):
+            job_idx = (self.start_idx + self.num_scanned) % len(self.jobs)
+            self.num_scanned += 1
+            if self._try_claim(job_idx):
+                self.lease_keeper.add(self.claims_dir / str(job_idx))
+                return job_idx, self.jobs[job_idx]
+        if self.last_steal_scan is None or \
+                time.time() - self.last_steal_scan > self.steal_scan_interval:
+            self._scan_for_steals()
+        while self.steal_candidates:
+            job_idx = self.steal_candidates.pop()
+            if job_idx not in self.done_jobs and self._try_steal(job_idx):
+                self.lease_keeper.add(self.claims_dir / str(job_idx))
+                return job_idx, self.jobs[job_idx]
+        return None
+
+    def _scan_for_steals(self) -> None:
+        self.done_jobs.update(int(name) for name in os.listdir(self.done_dir))
+        self.steal_candidates = [job_idx for job_idx
+                                 in reversed(range(len(self.jobs)))
+                                 if job_idx not in self.done_jobs]
+        self.last_steal_scan = time.time()
+
+    def finish(self, job_idx: int) -> None:
+        (self.done_dir / str(job_idx)).touch()
+        self.done_jobs.add(job_idx)
+        self.lease_keeper.remove(self.claims_dir / str(job_idx))
+
+
+class LeaseKeeper:
+    # Touches the claim files of the jobs a worker holds in the background,
+    # so that other workers don't think they've been abandoned.
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.claim_files: Set[Path] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def add(self, claim_file: Path) -> None:
+        with self.lock:
+            self.claim_files.add(claim_file)
+
+    def remove(self, claim_file: Path) -> None:
+        with self.lock:
+            self.claim_files.discard(claim_file)
+
+    def _renew(self) -> None:
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                claim_files = list(self.claim_files)
+            for claim_file in claim_files:
+                try:
+                    os.utime(claim_file)
+                except FileNotFoundError:
+                    pass
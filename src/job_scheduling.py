@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import json
+import math
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional
+
+from search_worker import ReportJob
+from search_results import SearchStatus
+
+
+def load_proof_times(path: Path, timeout: Optional[float] = None) \
+        -> Dict[ReportJob, float]:
+    # Reads how long each lemma took to search from the -proofs.txt files of
+    # a previous report (either a single file or a whole report directory).
+    # Reports written before search times were recorded only have the status;
+    # for those, a search that didn't succeed probably ran until the timeout,
+    # and anything else is left out.
+    if path.is_dir():
+        proofs_files = sorted(path.glob("**/*-proofs.txt"))
+    else:
+        proofs_files = [path]
+    proof_times: Dict[ReportJob, float] = {}
+    for proofs_file in proofs_files:
+        with proofs_file.open('r') as f:
+            for line in f:
+                job, sol = json.loads(line)
+                if sol.get("time") is not None:
+                    proof_times[ReportJob(*job)] = sol["time"]
+                elif timeout is not None and \
+                        sol["status"] != SearchStatus.SUCCESS.name:
+                    proof_times[ReportJob(*job)] = timeout
+    return proof_times
+
+
+def estimate_job_costs(jobs: List[ReportJob],
+                       proof_times: Dict[ReportJob, float]) \
+        -> Dict[ReportJob, float]:
+    # Lemmas that weren't in the previous report are assumed to take the
+    # average time.
+    if proof_times:
+        default_cost = sum(proof_times.values()) / len(proof_times)
+    else:
+        default_cost = 1.0
+    return {job: proof_times.get(job, default_cost) for job in jobs}
+
+
+def chunk_jobs_by_file(jobs: List[ReportJob], num_workers: int,
+                       max_chunk_size: int = 0,
+                       job_costs: Optional[Dict[ReportJob, float]] = None) \
+        -> List[List[ReportJob]]:
+    # Workers have to replay a file up to each lemma before searching it, so
+    # hand them runs of lemmas from the same file, in file order, instead of
+    # single jobs. Files with more than a fair share of the work get split up
+    # so that one long file doesn't leave the other workers idle.
+    #
+    # When we know how long each job is expected to take, the fair share is
+    # measured in expected time, and the longest chunks go first (LPT
+    # scheduling), so that the run doesn't end with one worker grinding
+    # through a slow lemma while the rest sit idle.
+    sort_by_cost = job_costs is not None
+    if job_costs is None:
+        job_costs = {job: 1.0 for job in jobs}
+    chunk_budget = sum(job_costs[job] for job in jobs) / (num_workers * 2)
+    if max_chunk_size <= 0:
+        max_chunk_size = len(jobs)
+    file_jobs: Dict[Tuple[str, str], List[ReportJob]] = {}
+    for job in jobs:
+        file_jobs.setdefault((job.project_dir, job.filename), []).append(job)
+    chunks: List[List[ReportJob]] = []
+    for jobs_in_file in file_jobs.values():
+        cur_chunk: List[ReportJob] = []
+        cur_chunk_cost = 0.0
+        for job in jobs_in_file:
+            if cur_chunk and (cur_chunk_cost + job_costs[job] > chunk_budget or
+                              len(cur_chunk) >= max_chunk_size):
+                chunks.append(cur_chunk)
+                cur_chunk = []
+                cur_chunk_cost = 0.0
+            cur_chunk.append(job)
+            cur_chunk_cost += job_costs[job]
+        if cur_chunk:
+            chunks.append(cur_chunk)
+    if sort_by_cost:
+        chunks.sort(key=lambda chunk: sum(job_costs[job] for job in chunk),
+                    reverse=True)
+    return chunks
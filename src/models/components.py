@@ -246,12 +246,12 @@ class EncoderRNN(nn.Module):
         input_var = maybe_cuda(Variable(input_seq))
         batch_size = input_seq.size()[0]
         hidden = maybe_cuda(Variable(torch.zeros(1, batch_size, self.hidden_size)))
-        for i in range(input_seq.size()[1]):
-            token_batch = self._word_embedding(input_var[:,i])\
-                .view(1, batch_size, self.hidden_size)
-            token_batch = F.relu(token_batch)
-            token_out, hidden = self._gru(token_batch, hidden)
-        result = self._out_layer(token_out.view(batch_size, self.hidden_size))
+        # Run the GRU over the whole sequence in one call, instead of a token
+        # at a time; the final hidden state is the output at the last token.
+        token_batches = F.relu(self._word_embedding(input_var))\
+            .transpose(0, 1)
+        _, hidden = self._gru(token_batches, hidden)
+        result = self._out_layer(hidden.view(batch_size, self.hidden_size))
         return result
 
 
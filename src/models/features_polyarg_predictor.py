@@ -20,6 +20,7 @@
 ##########################################################################
 
 from tqdm import tqdm
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -45,10 +46,10 @@ from models.tactic_predictor import (TrainablePredictor,
 import dataloader
 from dataloader import (features_polyarg_tensors,
                         features_polyarg_tensors_with_meta,
-                        sample_fpa,
-                        sample_fpa_batch,
-                        decode_fpa_result,
-                        encode_fpa_stem,
+                        sample_fpa_with_handle,
+                        sample_fpa_batch_with_handle,
+                        decode_fpa_results_with_handle,
+                        encode_fpa_stem_with_handle,
                         encode_fpa_arg,
                         decode_fpa_stem,
                         # decode_fpa_arg,
@@ -58,17 +59,26 @@ from dataloader import (features_polyarg_tensors,
                         get_word_feature_vocab_sizes,
                         get_vec_features_size,
                         DataloaderArgs,
+                        FPAMetadataHandle,
                         get_fpa_words)
 
 import coq_serapy as serapi_instance
 
 import argparse
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
 import sys
 from argparse import Namespace
+from pathlib import Path
 from typing import (List, Tuple, NamedTuple, Optional, Sequence, Dict,
                     cast, Union, Set, Type, Any, Iterable)
 
 from enum import Enum, auto
+from collections import OrderedDict
 
 
 class ArgType(Enum):
@@ -107,6 +117,51 @@ class FeaturesPolyArgDataset(ListDataset[FeaturesPolyArgSample]):
 FeaturesPolyargState = Tuple[Any, NeuralPredictorState]
 
 
+HypScoreKey = Tuple[int, str]
+
+
+class HypScoreCache:
+    # The hypothesis model's scores for premises, keyed by the stem they're
+    # arguments to and the goal, and then by the premise. The hyp encoder
+    # starts from a state computed from the stem and the goal, and the
+    # premise features compare it to the goal, so the scores can't be shared
+    # across goals; but within a search, the relevant lemmas and most
+    # hypotheses stay the same from node to node, and the same goals come up
+    # again and again. Keeping a row of scores per stem and goal means a
+    # context's premises are looked up with one row per stem, instead of one
+    # lookup per premise. The least recently used rows are evicted once
+    # there are more than max_size scores.
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.rows: 'OrderedDict[HypScoreKey, Dict[str, float]]' = \
+            OrderedDict()
+        self.num_scores = 0
+
+    def get_row(self, key: HypScoreKey) -> Dict[str, float]:
+        row = self.rows.get(key)
+        if row is None:
+            row = {}
+            self.rows[key] = row
+        else:
+            self.rows.move_to_end(key)
+        return row
+
+    def put(self, row: Dict[str, float], premise: str, score: float) -> None:
+        if premise not in row:
+            self.num_scores += 1
+        row[premise] = score
+
+    def evict(self) -> None:
+        while self.rows and (self.num_scores > self.max_size or
+                             len(self.rows) > self.max_size):
+            _, row = self.rows.popitem(last=False)
+            self.num_scores -= len(row)
+
+    def clear(self) -> None:
+        self.rows.clear()
+        self.num_scores = 0
+
+
 class GoalTokenEncoderModel(nn.Module):
     def __init__(self, stem_vocab_size: int,
                  input_vocab_size: int,
@@ -203,7 +258,7 @@ class HypArgEncoder(nn.Module):
             token_batch = F.relu(token_batch)
             token_out, hidden = self._hyp_gru(token_batch, hidden)
 
-        return token_out.squeeze()
+        return token_out.view(batch_size, self.hidden_size)
 
 class HypArgModel(nn.Module):
     def __init__(self, goal_data_size: int,
@@ -273,6 +328,26 @@ class FeaturesPolyArgModel(nn.Module):
         self.hyp_model = maybe_cuda(hyp_model)
 
 
+class CompiledPolyArgModel(nn.Module):
+    # Holds the traced parts of a FeaturesPolyArgModel, under the same names,
+    # so they can be scripted and saved as one TorchScript archive. Scripting
+    # needs a forward method, but the predictor calls the parts directly.
+    def __init__(self,
+                 stem_classifier: torch.jit.ScriptModule,
+                 goal_args_model: torch.jit.ScriptModule,
+                 goal_encoder: torch.jit.ScriptModule,
+                 hyp_model: torch.jit.ScriptModule) -> None:
+        super().__init__()
+        self.stem_classifier = stem_classifier
+        self.goal_args_model = goal_args_model
+        self.goal_encoder = goal_encoder
+        self.hyp_model = hyp_model
+
+    def forward(self, word_features_batch: torch.Tensor,
+                vec_features_batch: torch.Tensor) -> torch.Tensor:
+        return self.stem_classifier(word_features_batch, vec_features_batch)
+
+
 class FeaturesPolyargPredictor(
         TrainablePredictor[FeaturesPolyArgDataset,
                            Tuple[Tokenizer, Embedding,
@@ -290,6 +365,55 @@ class FeaturesPolyargPredictor(
         # self._tokenizer : Optional[Tokenizer] = None
         # self._embedding : Optional[Embedding] = None
         self._model: Optional[FeaturesPolyArgModel] = None
+        self._metadata_handle: Optional[FPAMetadataHandle] = None
+        self._hyp_score_cache: Optional[HypScoreCache] = None
+        self._cache_size = 0
+
+    # The native metadata handle can't be pickled, so it gets rebuilt from the
+    # pickleable metadata when the predictor is sent to another process.
+    # A compiled model can't be pickled either, so it's sent as the bytes of
+    # its TorchScript archive.
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_metadata_handle"] = None
+        if isinstance(self._model, torch.jit.ScriptModule):
+            buf = io.BytesIO()
+            torch.jit.save(self._model, buf)
+            state["_model"] = buf.getvalue()
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        if isinstance(self._model, bytes):
+            self._model = torch.jit.load(io.BytesIO(self._model),
+                                         map_location='cpu')
+        if self._model is not None:
+            self._build_metadata_handle()
+
+    def _build_metadata_handle(self) -> None:
+        assert self.training_args
+        self._dataloader_args = extract_dataloader_args(self.training_args)
+        frozen_metadata, self._num_indices = get_num_indices(self.metadata)
+        self._num_tokens = get_num_tokens(self.metadata)
+        self._metadata_handle = FPAMetadataHandle(frozen_metadata)
+        self._metadata_handle.set_premise_cache_size(self._cache_size)
+
+    # The cache size bounds both the hyp scores kept here, and the tokenized
+    # premises and premise features the metadata handle keeps natively.
+    def set_cache_size(self, cache_size: int) -> None:
+        self._cache_size = cache_size
+        if cache_size > 0:
+            self._hyp_score_cache = HypScoreCache(cache_size)
+        else:
+            self._hyp_score_cache = None
+        if self._metadata_handle is not None:
+            self._metadata_handle.set_premise_cache_size(cache_size)
+
+    def clear_caches(self) -> None:
+        if self._hyp_score_cache is not None:
+            self._hyp_score_cache.clear()
+        if self._metadata_handle is not None:
+            self._metadata_handle.clear_premise_features()
 
     @property
     def goal_token_encoder(self) -> GoalTokenEncoderModel:
@@ -344,19 +468,19 @@ class FeaturesPolyargPredictor(
         assert self.training_args
         assert self._model
 
-        num_stem_poss = get_num_tokens(self.metadata)
+        num_stem_poss = self._num_tokens
         stem_width = min(16, num_stem_poss)
 
         tokenized_premises, hyp_features, \
             nhyps_batch, tokenized_goal, \
             goal_mask, \
             word_features, vec_features = \
-            sample_fpa(extract_dataloader_args(self.training_args),
-                       self.metadata,
-                       context.relevant_lemmas,
-                       context.prev_tactics,
-                       context.hypotheses,
-                       context.goal)
+            sample_fpa_with_handle(self._dataloader_args,
+                                   self._metadata_handle,
+                                   context.relevant_lemmas,
+                                   context.prev_tactics,
+                                   context.hypotheses,
+                                   context.goal)
 
         stem_certainties, stem_idxs = self.predict_stems(
             stem_width, word_features, vec_features)
@@ -364,20 +488,17 @@ class FeaturesPolyargPredictor(
         goal_arg_values = self.goal_token_scores(
             stem_idxs, tokenized_goal, goal_mask)
 
-        if len(tokenized_premises[0]) > 0:
-            hyp_arg_values = self.hyp_name_scores(
-                stem_idxs[0], tokenized_goal[0],
-                tokenized_premises[0], hyp_features[0])
-
-            total_scores = torch.cat((goal_arg_values, hyp_arg_values), dim=2)
-        else:
-            total_scores = goal_arg_values
+        hyp_arg_values = self.hyp_name_scores_batch(
+            stem_idxs, [context.goal],
+            [context.hypotheses + context.relevant_lemmas],
+            tokenized_goal, tokenized_premises, hyp_features, nhyps_batch)
+        total_scores = torch.cat((goal_arg_values, hyp_arg_values), dim=2)
 
         final_probs, predicted_stem_idxs, predicted_arg_idxs = \
             self.predict_args(total_scores, stem_certainties, stem_idxs)
 
-        result = list(zip(list(final_probs), list(predicted_stem_idxs),
-                          list(predicted_arg_idxs)))
+        result = list(zip(final_probs.tolist(), predicted_stem_idxs.tolist(),
+                          predicted_arg_idxs.tolist()))
         return result
 
     def getAllPredictionIdxs_batch(self, contexts: List[TacticContext],
@@ -385,17 +506,17 @@ class FeaturesPolyargPredictor(
         assert self.training_args
         assert self._model
 
-        num_stem_poss = get_num_tokens(self.metadata)
+        num_stem_poss = self._num_tokens
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
         tokenized_premises_batch, premise_features_batch, \
             nhyps_batch, tokenized_goal_batch, \
             goal_mask, \
             word_features, vec_features = \
-            sample_fpa_batch(extract_dataloader_args(self.training_args),
-                             self.metadata,
-                             [context_py2r(context)
-                              for context in contexts])
+            sample_fpa_batch_with_handle(self._dataloader_args,
+                                         self._metadata_handle,
+                                         [context_py2r(context)
+                                          for context in contexts])
 
         stem_certainties_batch, stem_idxs_batch = self.predict_stems(
             stem_width, word_features, vec_features)
@@ -403,33 +524,35 @@ class FeaturesPolyargPredictor(
         goal_arg_values_batch = self.goal_token_scores(
             stem_idxs_batch, tokenized_goal_batch, goal_mask)
 
-        idxs_batch = []
+        premise_arg_values_batch = self.hyp_name_scores_batch(
+            stem_idxs_batch,
+            [context.goal for context in contexts],
+            [context.hypotheses + context.relevant_lemmas
+             for context in contexts],
+            tokenized_goal_batch, tokenized_premises_batch,
+            premise_features_batch, nhyps_batch)
+        total_scores_batch = torch.cat((goal_arg_values_batch,
+                                        premise_arg_values_batch),
+                                       dim=2)
+
+        probs_batch, stems_batch, args_batch = self.predict_args_batch(
+            total_scores_batch, stem_certainties_batch, stem_idxs_batch)
+
+        # Drop the scores for the padding hypotheses, which all come after
+        # the real arguments of their stem.
+        num_goal_probs = goal_arg_values_batch.size()[2]
+        valid_batch = args_batch < \
+            (LongTensor(nhyps_batch) + num_goal_probs).unsqueeze(1)
 
-        for (stem_certainties, stem_idxs,
-             goal_arg_values, tokenized_goal,
-             tokenized_premises,
-             premise_features) in \
-            tqdm(zip(stem_certainties_batch, stem_idxs_batch,
-                     goal_arg_values_batch, tokenized_goal_batch,
-                     tokenized_premises_batch, premise_features_batch),
-                 desc="Assessing hyp args and decoding indices",
+        idxs_batch = []
+        for probs, stems, args, valid in \
+            tqdm(zip(probs_batch, stems_batch, args_batch, valid_batch),
+                 desc="Decoding indices",
                  total=len(contexts),
                  disable=verbosity <= 1):
-            if len(tokenized_premises) > 0:
-                premise_arg_values = self.hyp_name_scores(
-                    stem_idxs,
-                    tokenized_goal,
-                    tokenized_premises,
-                    premise_features)
-                total_scores = torch.cat((goal_arg_values.unsqueeze(0),
-                                          premise_arg_values),
-                                         dim=2)
-            else:
-                total_scores = goal_arg_values.unsqueeze(0)
-
-            probs, stems, args = self.predict_args(
-                total_scores, stem_certainties, stem_idxs)
-            idxs_batch.append(list(zip(list(probs), list(stems), list(args))))
+            idxs_batch.append(list(zip(probs[valid].tolist(),
+                                       stems[valid].tolist(),
+                                       args[valid].tolist())))
 
         return idxs_batch
 
@@ -438,7 +561,7 @@ class FeaturesPolyargPredictor(
             all_idxs: List[Tuple[float, int, int]],
             k: int) -> List[Prediction]:
         assert self.training_args
-        num_stem_poss = get_num_tokens(self.metadata)
+        num_stem_poss = self._num_tokens
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
 
         if self.training_args.lemma_args:
@@ -446,26 +569,18 @@ class FeaturesPolyargPredictor(
         else:
             all_hyps = context.hypotheses
 
-        prediction_strs: List[str] = []
-        prediction_probs: List[float] = []
-        next_i = 0
         num_valid_probs = (1 + len(all_hyps) +
                            len(get_fpa_words(context.goal))) * stem_width
-        while len(prediction_strs) < k and next_i < num_valid_probs:
-            next_pred_str = decode_fpa_result(
-                extract_dataloader_args(self.training_args),
-                self.metadata,
-                all_hyps, context.goal,
-                all_idxs[next_i][1],
-                all_idxs[next_i][2])
-            # next_pred_str = ""
-            if next_pred_str not in prediction_strs:
-                prediction_strs.append(next_pred_str)
-                prediction_probs.append(math.exp(all_idxs[next_i][0]))
-            next_i += 1
-
-        predictions = [Prediction(s, prob) for s, prob in
-                       zip(prediction_strs, prediction_probs)]
+        valid_idxs = all_idxs[:num_valid_probs]
+        decoded = decode_fpa_results_with_handle(
+            self._dataloader_args,
+            self._metadata_handle,
+            all_hyps, context.goal,
+            [(stem_idx, arg_idx) for _, stem_idx, arg_idx in valid_idxs],
+            k)
+
+        predictions = [Prediction(pred_str, math.exp(valid_idxs[i][0]))
+                       for i, pred_str in decoded]
 
         return predictions
 
@@ -483,83 +598,94 @@ class FeaturesPolyargPredictor(
         return predictions
 
     def predictionCertainty(self, context: TacticContext, prediction: str) -> float:
+        return self.predictionCertainty_batch([context], [prediction])[0]
 
+    def predictionCertainty_batch(self, contexts: List[TacticContext],
+                                  predictions: List[str]) -> List[float]:
+        # The probability the model gives each prediction in its context.
+        # When the prediction's stem isn't in the top stem_width stems, it
+        # takes the place of the last one, so its arguments get scored.
         assert self.training_args
         assert self._model
+        assert len(contexts) == len(predictions)
 
-        self.metadata, num_stem_poss = get_num_indices(self.metadata)
+        num_stem_poss = self._num_indices
         stem_width = min(self.training_args.max_beam_width, num_stem_poss)
+        batch_size = len(contexts)
 
-        tokenized_premises, hyp_features, \
-            nhyps_batch, tokenized_goal, \
+        tokenized_premises_batch, premise_features_batch, \
+            nhyps_batch, tokenized_goal_batch, \
             goal_mask, \
             word_features, vec_features = \
-            sample_fpa(extract_dataloader_args(self.training_args),
-                       self.metadata,
-                       context.relevant_lemmas,
-                       context.prev_tactics,
-                       context.hypotheses,
-                       context.goal)
-
-        prediction_stem, prediction_args = \
-            serapi_instance.split_tactic(prediction)
-        prediction_stem_idx = encode_fpa_stem(extract_dataloader_args(self.training_args),
-                                              self.metadata, prediction_stem)
-        assert prediction_stem_idx < num_stem_poss
+            sample_fpa_batch_with_handle(self._dataloader_args,
+                                         self._metadata_handle,
+                                         [context_py2r(context)
+                                          for context in contexts])
+
+        prediction_stem_idxs_list: List[int] = []
+        prediction_arg_idxs_list: List[int] = []
+        for context, prediction in zip(contexts, predictions):
+            prediction_stem, prediction_args = \
+                serapi_instance.split_tactic(prediction)
+            prediction_stem_idx = encode_fpa_stem_with_handle(
+                self._dataloader_args, self._metadata_handle, prediction_stem)
+            assert prediction_stem_idx < num_stem_poss
+            prediction_arg_idx = encode_fpa_arg(
+                self._dataloader_args,
+                self.metadata,
+                context.hypotheses + context.relevant_lemmas,
+                context.goal,
+                prediction_args)
+            assert prediction_arg_idx is not None, \
+                (prediction, prediction_args, context.goal,
+                 [serapi_instance.get_var_term_in_hyp(hyp) for hyp
+                  in context.hypotheses + context.relevant_lemmas])
+            prediction_stem_idxs_list.append(prediction_stem_idx)
+            prediction_arg_idxs_list.append(prediction_arg_idx)
+        prediction_stem_idxs = LongTensor(prediction_stem_idxs_list)\
+            .view(batch_size, 1)
+        prediction_arg_idxs = LongTensor(prediction_arg_idxs_list)\
+            .view(batch_size, 1)
+
         stem_distributions = self._model.stem_classifier(
-            maybe_cuda(torch.LongTensor(word_features)),
-            maybe_cuda(torch.FloatTensor(vec_features)))
+            LongTensor(word_features), FloatTensor(vec_features))
         stem_certainties, stem_idxs = stem_distributions.topk(stem_width)
-        if prediction_stem_idx in stem_idxs[0]:
-            merged_stem_idxs = stem_idxs
-            merged_stem_certainties = stem_certainties
-        else:
-            merged_stem_idxs = torch.cat(
-                (maybe_cuda(torch.LongTensor([[prediction_stem_idx]])),
-                 stem_idxs[:, :stem_width-1]),
-                dim=1)
-            cother = stem_certainties[:, :stem_width-1]
-            val = stem_distributions[0][prediction_stem_idx]
-            merged_stem_certainties = \
-                torch.cat((val.view(1, 1), cother),dim=1)
-
-        prediction_stem_idx_idx = list(merged_stem_idxs[0]).index(
-            prediction_stem_idx)
-        prediction_arg_idx = encode_fpa_arg(
-            extract_dataloader_args(self.training_args),
-            self.metadata,
-            context.hypotheses + context.relevant_lemmas,
-            context.goal,
-            prediction_args)
-        assert prediction_arg_idx is not None, \
-            (prediction, prediction_args, context.goal,
-             [serapi_instance.get_var_term_in_hyp(hyp) for hyp
-              in context.hypotheses + context.relevant_lemmas])
+        stem_in_top = (stem_idxs == prediction_stem_idxs)\
+            .any(dim=1, keepdim=True)
+        merged_stem_idxs = torch.where(
+            stem_in_top, stem_idxs,
+            torch.cat((prediction_stem_idxs, stem_idxs[:, :stem_width-1]),
+                      dim=1))
+        merged_stem_certainties = torch.where(
+            stem_in_top, stem_certainties,
+            torch.cat((stem_distributions.gather(1, prediction_stem_idxs),
+                       stem_certainties[:, :stem_width-1]),
+                      dim=1))
+        prediction_stem_idx_idxs = (merged_stem_idxs == prediction_stem_idxs)\
+            .int().argmax(dim=1, keepdim=True)
 
         goal_arg_values = self.goal_token_scores(
-            merged_stem_idxs, tokenized_goal, goal_mask)
-
-        if len(tokenized_premises[0]) > 0:
-            hyp_arg_values = self.hyp_name_scores(
-                merged_stem_idxs[0], tokenized_goal[0],
-                tokenized_premises[0], hyp_features[0])
-
-            total_scores = torch.cat((goal_arg_values, hyp_arg_values), dim=2)
-        else:
-            total_scores = goal_arg_values
-
-        final_probs, predicted_stem_idxs, predicted_arg_idxs = \
-            self.predict_args(total_scores, merged_stem_certainties,
-                              merged_stem_idxs)
-
-        for prob, stem_idx_idx, arg_idx in zip(final_probs,
-                                               predicted_stem_idxs,
-                                               predicted_arg_idxs):
-            if stem_idx_idx == prediction_stem_idx and \
-               arg_idx == prediction_arg_idx:
-                return math.exp(prob.item())
-
-        assert False, "Shouldn't be able to get here"
+            merged_stem_idxs, tokenized_goal_batch, goal_mask)
+        hyp_arg_values = self.hyp_name_scores_batch(
+            merged_stem_idxs,
+            [context.goal for context in contexts],
+            [context.hypotheses + context.relevant_lemmas
+             for context in contexts],
+            tokenized_goal_batch, tokenized_premises_batch,
+            premise_features_batch, nhyps_batch)
+        total_scores = torch.cat((goal_arg_values, hyp_arg_values), dim=2)
+        num_probs_per_stem = total_scores.size()[2]
+        all_probs = self._softmax(
+            (total_scores +
+             merged_stem_certainties.view(batch_size, stem_width, 1)
+             .expand(-1, -1, num_probs_per_stem))
+            .contiguous()
+            .view(batch_size, stem_width * num_probs_per_stem))
+        prediction_probs = all_probs.gather(
+            1, prediction_stem_idx_idxs * num_probs_per_stem +
+            prediction_arg_idxs)
+        return [math.exp(prob) for prob in prediction_probs.view(batch_size)
+                .tolist()]
 
     def predict_stems(self, k: int,
                       word_features: List[List[int]],
@@ -605,32 +731,127 @@ class FeaturesPolyargPredictor(
             [batch_size, stem_width, num_goal_probs])
         return masked_probabilities
 
-    def hyp_name_scores(self,
-                        stem_idxs: torch.LongTensor,
-                        tokenized_goal: List[int],
-                        tokenized_premises: List[List[int]],
-                        premise_features: List[List[float]]
-                        ) -> torch.FloatTensor:
+    def hyp_name_scores_batch(self,
+                              stem_idxs: torch.LongTensor,
+                              goals: List[str],
+                              premises_batch: List[List[str]],
+                              tokenized_goals: List[List[int]],
+                              tokenized_premises_batch: List[List[List[int]]],
+                              premise_features_batch: List[List[List[float]]],
+                              nhyps_batch: List[int]
+                              ) -> torch.FloatTensor:
+        # Scores the hypotheses of a whole batch of contexts at once. The
+        # premise lists are padded to the longest one, and the padding gets a
+        # score of -inf, so it never gets any probability mass.
         assert self._model
-        assert len(stem_idxs.size()) == 1
-        stem_width = stem_idxs.size()[0]
-        num_hyps = len(tokenized_premises)
-        encoded_goals = self._model.goal_encoder(LongTensor([tokenized_goal]))
-        hyp_arg_values = self.runHypModel(stem_idxs.unsqueeze(0),
-                                          encoded_goals,
-                                          LongTensor([tokenized_premises]),
-                                          FloatTensor([premise_features]))
-        assert hyp_arg_values.size() == torch.Size([1, stem_width, num_hyps])
+        assert self.training_args
+        batch_size = stem_idxs.size()[0]
+        stem_width = stem_idxs.size()[1]
+        max_hyps = max(nhyps_batch, default=0)
+        if max_hyps == 0:
+            return maybe_cuda(torch.zeros(batch_size, stem_width, 0))
+        if self._hyp_score_cache is not None:
+            return self._cached_hyp_name_scores(
+                stem_idxs, goals, premises_batch, tokenized_goals,
+                tokenized_premises_batch, premise_features_batch, max_hyps)
+        features_size = next(len(premise_features[0]) for premise_features
+                             in premise_features_batch if premise_features)
+        padded_premises = [tokenized_premises +
+                           [[0] * self.training_args.max_length] *
+                           (max_hyps - len(tokenized_premises))
+                           for tokenized_premises in tokenized_premises_batch]
+        padded_features = [premise_features +
+                           [[0.] * features_size] *
+                           (max_hyps - len(premise_features))
+                           for premise_features in premise_features_batch]
+        encoded_goals = self._model.goal_encoder(LongTensor(tokenized_goals))
+        unmasked_values = self.runHypModel(stem_idxs, encoded_goals,
+                                           LongTensor(padded_premises),
+                                           FloatTensor(padded_features))
+        hyp_mask = maybe_cuda(torch.arange(max_hyps)).view(1, max_hyps) < \
+            LongTensor(nhyps_batch).view(batch_size, 1)
+        hyp_arg_values = torch.where(
+            hyp_mask.view(batch_size, 1, max_hyps)
+            .expand(-1, stem_width, -1),
+            unmasked_values,
+            torch.full_like(unmasked_values, -float("Inf")))
+        assert hyp_arg_values.size() == torch.Size(
+            [batch_size, stem_width, max_hyps])
         return hyp_arg_values
 
+    def _cached_hyp_name_scores(self,
+                                stem_idxs: torch.LongTensor,
+                                goals: List[str],
+                                premises_batch: List[List[str]],
+                                tokenized_goals: List[List[int]],
+                                tokenized_premises_batch: List[List[List[int]]],
+                                premise_features_batch: List[List[List[float]]],
+                                max_hyps: int
+                                ) -> torch.FloatTensor:
+        # Like hyp_name_scores_batch, but only runs the hyp model on the
+        # (stem, goal, premise) triples that aren't in the cache.
+        assert self._model
+        assert self._hyp_score_cache is not None
+        stems_batch = stem_idxs.tolist()
+        hyp_arg_values: List[List[List[Optional[float]]]] = []
+        misses: List[Tuple[int, int, int]] = []
+        miss_rows: List[Dict[str, float]] = []
+        for context_idx, (stems, goal, premises) in \
+                enumerate(zip(stems_batch, goals, premises_batch)):
+            padding = [-float("Inf")] * (max_hyps - len(premises))
+            context_values = []
+            for stem_idx_idx, stem in enumerate(stems):
+                row = self._hyp_score_cache.get_row((stem, goal))
+                values = [row.get(premise) for premise in premises]
+                if None in values:
+                    for premise_idx, value in enumerate(values):
+                        if value is None:
+                            misses.append((context_idx, stem_idx_idx,
+                                           premise_idx))
+                            miss_rows.append(row)
+                context_values.append(values + padding)
+            hyp_arg_values.append(context_values)
+        if misses:
+            encoded_goals = self._model.goal_encoder(
+                LongTensor(tokenized_goals))
+            miss_scores = self._model.hyp_model(
+                LongTensor([stems_batch[context_idx][stem_idx_idx]
+                            for context_idx, stem_idx_idx, _ in misses]),
+                encoded_goals.index_select(
+                    0, LongTensor([context_idx
+                                   for context_idx, _, _ in misses])),
+                LongTensor([tokenized_premises_batch[context_idx][premise_idx]
+                            for context_idx, _, premise_idx in misses]),
+                FloatTensor([premise_features_batch[context_idx][premise_idx]
+                             for context_idx, _, premise_idx in misses]))\
+                .view(len(misses)).tolist()
+            for (context_idx, stem_idx_idx, premise_idx), row, score in \
+                    zip(misses, miss_rows, miss_scores):
+                hyp_arg_values[context_idx][stem_idx_idx][premise_idx] = score
+                self._hyp_score_cache.put(
+                    row, premises_batch[context_idx][premise_idx], score)
+        self._hyp_score_cache.evict()
+        return FloatTensor(hyp_arg_values)
+
     def predict_args(self,
                      total_scores: torch.FloatTensor,
                      stem_certainties: torch.FloatTensor,
                      stem_idxs: torch.LongTensor
                      ) -> Tuple[torch.FloatTensor, torch.LongTensor,
                                 torch.LongTensor]:
+        assert total_scores.size()[0] == 1
+        prediction_probs, predicted_stem_idxs, predicted_arg_idxs = \
+            self.predict_args_batch(total_scores, stem_certainties, stem_idxs)
+        return prediction_probs[0], predicted_stem_idxs[0], \
+            predicted_arg_idxs[0]
+
+    def predict_args_batch(self,
+                           total_scores: torch.FloatTensor,
+                           stem_certainties: torch.FloatTensor,
+                           stem_idxs: torch.LongTensor
+                           ) -> Tuple[torch.FloatTensor, torch.LongTensor,
+                                      torch.LongTensor]:
         batch_size = total_scores.size()[0]
-        assert batch_size == 1
         stem_width = total_scores.size()[1]
         num_probs_per_stem = total_scores.size()[2]
         all_prob_batches = self._softmax(
@@ -646,12 +867,10 @@ class FeaturesPolyargPredictor(
             [batch_size, stem_width * num_probs_per_stem])
         predicted_stem_keys = torch.div(arg_idxs, num_probs_per_stem,
                                         rounding_mode="floor")
-        predicted_stem_idxs = stem_idxs.view(stem_width)\
-                                       .index_select(
-                                           0, predicted_stem_keys.squeeze(
-                                               dim=0))
+        predicted_stem_idxs = stem_idxs.view(batch_size, stem_width)\
+                                       .gather(1, predicted_stem_keys)
         predicted_arg_idxs = arg_idxs % num_probs_per_stem
-        return prediction_probs[0], predicted_stem_idxs, predicted_arg_idxs[0]
+        return prediction_probs, predicted_stem_idxs, predicted_arg_idxs
 
     def predictKTacticsWithLoss(self, in_data: TacticContext, k: int, correct: str) -> \
             Tuple[List[Prediction], float]:
@@ -668,7 +887,6 @@ class FeaturesPolyargPredictor(
         assert self._model
         assert self.training_args
         batch_size = encoded_goals.size()[0]
-        assert batch_size == 1
         num_hyps = hyps_batch.size()[1]
         beam_width = stem_idxs.size()[1]
         if hypfeatures_batch.size()[1] == 0:
@@ -750,6 +968,12 @@ class FeaturesPolyargPredictor(
         parser.add_argument("--print-tensors", action="store_true")
         parser.add_argument("--load-text-tokens", default=None)
         parser.add_argument("--load-tensors", default=None)
+        parser.add_argument("--featurized-cache", type=Path, default=None,
+                            help="Directory to keep featurized training "
+                            "data in, keyed by the contents of the scrape "
+                            "and keywords files and the featurization "
+                            "arguments, so runs on the same data only "
+                            "featurize it once")
 
         parser.add_argument("--save-embedding", type=str, default=None)
         parser.add_argument("--save-features-state", type=str, default=None)
@@ -762,11 +986,15 @@ class FeaturesPolyargPredictor(
                                                List[WordFeature], List[VecFeature]]]:
         pass
 
-    def _optimize_model(self, arg_values: Namespace) -> Iterable[FeaturesPolyargState]:
+    def _featurize_data(self, arg_values: Namespace) \
+            -> Tuple[Any, Tuple[List[int], int], List[torch.Tensor],
+                     Optional[Tuple[List[str], NeuralPredictorState]]]:
+        old_state: Optional[Tuple[List[str], NeuralPredictorState]] = None
         with print_time("Loading data", guard=arg_values.verbose):
             if arg_values.start_from:
                 _, (old_arg_values, unparsed_args,
                     metadata, state) = torch.load(arg_values.start_from)
+                old_state = (unparsed_args, state)
                 _, data_lists, \
                     (word_features_size, vec_features_size) = \
                     features_polyarg_tensors_with_meta(
@@ -805,13 +1033,34 @@ class FeaturesPolyargPredictor(
                        torch.FloatTensor(vec_features),
                        torch.LongTensor(tactic_stem_indices),
                        torch.LongTensor(arg_indices)]
-            with open("tensors.pickle", 'wb') as f:
-                torch.save(tensors, f)
-            eprint(tensors, guard=arg_values.print_tensors)
+        return metadata, (word_features_size, vec_features_size), tensors, \
+            old_state
+
+    def _optimize_model(self, arg_values: Namespace) -> Iterable[FeaturesPolyargState]:
+        cache_dir = featurized_cache_dir(arg_values)
+        cached = load_featurized_cache(cache_dir) if cache_dir else None
+        old_state: Optional[Tuple[List[str], NeuralPredictorState]] = None
+        if cached:
+            eprint(f"Loaded featurized data from {cache_dir}",
+                   guard=arg_values.verbose)
+            metadata, (word_features_size, vec_features_size), tensors = \
+                cached
+        else:
+            metadata, (word_features_size, vec_features_size), tensors, \
+                old_state = self._featurize_data(arg_values)
+            if cache_dir:
+                save_featurized_cache(cache_dir, metadata,
+                                      (word_features_size, vec_features_size),
+                                      tensors)
+            else:
+                with open("tensors.pickle", 'wb') as f:
+                    torch.save(tensors, f)
+        eprint(tensors, guard=arg_values.print_tensors)
 
         with print_time("Building the model", guard=arg_values.verbose):
 
             if arg_values.start_from:
+                unparsed_args, state = unwrap(old_state)
                 self.load_saved_state(arg_values, unparsed_args,
                                       metadata, state)
                 model = self._model
@@ -850,6 +1099,88 @@ class FeaturesPolyargPredictor(
         self.training_args = args
         self.unparsed_args = unparsed_args
         self.metadata = metadata
+        self._build_metadata_handle()
+
+    def can_quantize(self) -> bool:
+        # Compiled models are quantized (or not) when they're exported
+        return self._model is not None and \
+            not isinstance(self._model, torch.jit.ScriptModule)
+
+    def quantize(self) -> None:
+        # Swaps the Linear and GRU layers for dynamically quantized int8
+        # ones, which are faster on the CPU at some cost in accuracy (see
+        # check_quantization.py).
+        assert self._model
+        assert not util.use_cuda, "Quantized models only run on the CPU"
+        assert not isinstance(self._model, torch.jit.ScriptModule), \
+            "Quantize before compiling the model"
+        self._model = torch.quantization.quantize_dynamic(
+            self._model, {nn.Linear, nn.GRU}, dtype=torch.qint8)
+
+    def compiled_state(self) -> Tuple[Namespace, List[str], Any,
+                                      Optional[float], Optional[int]]:
+        # Everything besides the model that load_compiled_state needs
+        assert self.training_args
+        return (self.training_args, self.unparsed_args, self.metadata,
+                self.training_loss, self.num_epochs)
+
+    def compile_model(self) -> torch.jit.ScriptModule:
+        # Traces each part of the model for CPU inference. The traces are
+        # checked against the eager model on a second batch size, so a
+        # part that doesn't trace faithfully fails here instead of
+        # changing predictions during search.
+        assert self._model
+        assert self.training_args
+        assert not util.use_cuda, "Compile models on the CPU"
+        model = self._model
+        max_length = self.training_args.max_length
+        hidden_size = self.training_args.hidden_size
+        num_word_features = len(get_word_feature_vocab_sizes(self.metadata))
+        vec_features_size = get_vec_features_size(self.metadata)
+
+        def example_inputs(batch_size: int) -> Dict[str, Tuple[torch.Tensor,
+                                                                ...]]:
+            return {
+                "stem_classifier":
+                (torch.zeros(batch_size, num_word_features, dtype=torch.long),
+                 torch.rand(batch_size, vec_features_size)),
+                "goal_args_model":
+                (torch.zeros(batch_size, dtype=torch.long),
+                 torch.randint(self._num_tokens, (batch_size, max_length))),
+                "goal_encoder":
+                (torch.randint(self._num_tokens, (batch_size, max_length)),),
+                "hyp_model":
+                (torch.zeros(batch_size, dtype=torch.long),
+                 torch.rand(batch_size, hidden_size),
+                 torch.randint(self._num_tokens, (batch_size, max_length)),
+                 torch.rand(batch_size, hypFeaturesSize()))}
+        inputs = example_inputs(2)
+        check_inputs = example_inputs(5)
+        with torch.no_grad():
+            traced = {name: torch.jit.trace(getattr(model, name),
+                                            inputs[name],
+                                            check_inputs=[inputs[name],
+                                                          check_inputs[name]])
+                      for name in inputs}
+        return torch.jit.script(CompiledPolyArgModel(**traced))
+
+    def load_compiled_state(self,
+                            model: torch.jit.ScriptModule,
+                            args: Namespace,
+                            unparsed_args: List[str],
+                            metadata: Any,
+                            training_loss: Optional[float],
+                            num_epochs: Optional[int]) -> None:
+        assert not util.use_cuda, \
+            "Compiled polyarg models only run on the CPU"
+        # The compiled model has the same parts as a FeaturesPolyArgModel
+        self._model = cast(FeaturesPolyArgModel, model)
+        self.training_loss = training_loss
+        self.num_epochs = num_epochs
+        self.training_args = args
+        self.unparsed_args = unparsed_args
+        self.metadata = metadata
+        self._build_metadata_handle()
 
     def _get_model(self, arg_values: Namespace,
                    wordf_sizes: List[int],
@@ -1003,6 +1334,77 @@ def extract_dataloader_args(args: argparse.Namespace) -> DataloaderArgs:
     return dargs
 
 
+# Bump this when the featurization changes, so old cache entries are ignored
+FEATURIZED_CACHE_VERSION = 1
+FEATURIZED_CACHE_TENSORS = ["tokenized_hyp_types", "hyp_features", "num_hyps",
+                            "tokenized_goals", "goal_masks", "word_features",
+                            "vec_features", "tactic_stem_indices",
+                            "arg_indices"]
+
+
+def featurized_cache_dir(args: argparse.Namespace) -> Optional[Path]:
+    # Where the featurized data for these arguments goes in the featurized
+    # cache, if it can be cached. Training that starts from old weights
+    # featurizes with their metadata, and saving the embedding or features
+    # state needs the featurization to actually run, so those aren't cached.
+    if args.featurized_cache is None or args.start_from or \
+            args.save_embedding or args.save_features_state:
+        return None
+    key = hashlib.sha256()
+    key.update(json.dumps({"version": FEATURIZED_CACHE_VERSION,
+                           "max_tuples": args.max_tuples,
+                           "max_length": args.max_length,
+                           "num_keywords": args.num_keywords,
+                           "max_string_distance": args.max_string_distance,
+                           "max_premises": args.max_premises,
+                           "num_relevance_samples":
+                           args.num_relevance_samples,
+                           "context_filter": args.context_filter},
+                          sort_keys=True).encode())
+    for filename in [args.scrape_file, args.load_tokens,
+                     args.load_embedding, args.load_features_state]:
+        if filename is None:
+            key.update(b"\0")
+            continue
+        with open(str(filename), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                key.update(block)
+        key.update(b"\0")
+    return args.featurized_cache / key.hexdigest()
+
+
+def load_featurized_cache(cache_dir: Path) \
+        -> Optional[Tuple[Any, Tuple[List[int], int], List[torch.Tensor]]]:
+    if not cache_dir.exists():
+        return None
+    with (cache_dir / "metadata.pickle").open('rb') as f:
+        metadata, features_sizes = pickle.load(f)
+    # The tensors are memory-mapped copy-on-write, so only the parts that
+    # training touches get read, and nothing is written back.
+    tensors = [torch.from_numpy(np.load(cache_dir / f"{name}.npy",
+                                        mmap_mode='c'))
+               for name in FEATURIZED_CACHE_TENSORS]
+    return metadata, features_sizes, tensors
+
+
+def save_featurized_cache(cache_dir: Path, metadata: Any,
+                          features_sizes: Tuple[List[int], int],
+                          tensors: List[torch.Tensor]) -> None:
+    # Written to a temporary directory and renamed into place, so concurrent
+    # runs never see a partial entry.
+    tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp-{os.getpid()}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    with (tmp_dir / "metadata.pickle").open('wb') as f:
+        pickle.dump((metadata, features_sizes), f)
+    for name, tensor in zip(FEATURIZED_CACHE_TENSORS, tensors):
+        np.save(tmp_dir / f"{name}.npy", tensor.numpy())
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another run cached the same data first
+        shutil.rmtree(tmp_dir)
+
+
 def context_py2r(py_context: TacticContext) -> dataloader.TacticContext:
     return dataloader.TacticContext(
         py_context.relevant_lemmas, py_context.prev_tactics,
@@ -29,6 +29,9 @@ class TacticPredictor(metaclass=ABCMeta):
     @abstractmethod
     def predictKTactics(self, in_data : TacticContext, k : int) \
         -> List[Prediction]: pass
+    def predictKTactics_batch(self, in_datas : List[TacticContext], k : int) \
+        -> List[List[Prediction]]:
+        return [self.predictKTactics(in_data, k) for in_data in in_datas]
     @abstractmethod
     def predictKTacticsWithLoss(self, in_data : TacticContext, k : int, correct : str) -> \
         Tuple[List[Prediction], float]: pass
@@ -37,6 +40,19 @@ class TacticPredictor(metaclass=ABCMeta):
                                       in_data : List[TacticContext],
                                       k : int, correct : List[str]) -> \
                                       Tuple[List[List[Prediction]], float]: pass
+    # Predictors that cache work between predictions are told how big to let
+    # their caches get, and when a new lemma starts, so they can drop what
+    # won't be useful anymore.
+    def set_cache_size(self, cache_size : int) -> None:
+        pass
+    def clear_caches(self) -> None:
+        pass
+    # Predictors that can swap their model for a dynamically quantized one
+    # say so here; quantize is only called on those that do.
+    def can_quantize(self) -> bool:
+        return False
+    def quantize(self) -> None:
+        pass
 
 from typing import TypeVar, Generic, Sized
 import argparse
@@ -21,8 +21,12 @@
 ##########################################################################
 
 import torch
+import argparse
+import pickle
+import zipfile
 from typing import Dict, List, Union, Callable
 import functools
+import util
 from models.tactic_predictor import TacticPredictor, TrainablePredictor
 from models.components import DNNClassifierModel
 
@@ -110,7 +114,34 @@ def loadPredictorByName(predictor_type : str) -> TacticPredictor:
     # predictor". But I don't know how to specify that.
     return static_predictors[predictor_type]() # type: ignore
 
+# Predictors whose models can be exported as TorchScript, for faster
+# inference on CPU-only machines.
+compilable_predictors = {
+    "polyarg" : features_polyarg_predictor.FeaturesPolyargPredictor,
+}
+
+def isCompiledPredictorFile(filename : str) -> bool:
+    # Compiled predictors are TorchScript archives, which keep the predictor
+    # type and state as extra files next to the model code.
+    if not zipfile.is_zipfile(str(filename)):
+        return False
+    with zipfile.ZipFile(str(filename)) as archive:
+        return any(name.endswith("/extra/predictor_type")
+                   for name in archive.namelist())
+
+def loadCompiledPredictorByFile(filename : str) -> TrainablePredictor:
+    extra_files = {"predictor_type": "", "predictor_state": ""}
+    model = torch.jit.load(str(filename), map_location='cpu',
+                           _extra_files=extra_files)
+    predictor_type = extra_files["predictor_type"].decode()
+    predictor = compilable_predictors[predictor_type]() # type: ignore
+    predictor.load_compiled_state(
+        model, *pickle.loads(extra_files["predictor_state"]))
+    return predictor
+
 def loadPredictorByFile(filename : str) -> TrainablePredictor:
+    if isCompiledPredictorFile(filename):
+        return loadCompiledPredictorByFile(filename)
     predictor_type, saved_state = torch.load(str(filename), map_location='cpu')
     # Silencing the type checker on this line because the "real" type
     # of the predictors dictionary is "string to classes constructors
@@ -119,3 +150,27 @@ def loadPredictorByFile(filename : str) -> TrainablePredictor:
     predictor = loadable_predictors[predictor_type]() # type: ignore
     predictor.load_saved_state(*saved_state)
     return predictor
+
+def exportPredictor(args : List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Compile a trained predictor to TorchScript, for faster "
+        "search on CPU-only machines. The result can be passed to "
+        "--weightsfile like the original weights.")
+    parser.add_argument("weightsfile")
+    parser.add_argument("output")
+    parser.add_argument("--quantize", action='store_true',
+                        help="Quantize the model to int8 before compiling it")
+    arg_values = parser.parse_args(args)
+    util.use_cuda = False
+    predictor_type, saved_state = torch.load(arg_values.weightsfile,
+                                             map_location='cpu')
+    assert predictor_type in compilable_predictors, \
+        f"Can't compile {predictor_type} predictors"
+    predictor = compilable_predictors[predictor_type]() # type: ignore
+    predictor.load_saved_state(*saved_state)
+    if arg_values.quantize:
+        predictor.quantize()
+    torch.jit.save(predictor.compile_model(), arg_values.output,
+                   _extra_files={"predictor_type": predictor_type,
+                                 "predictor_state":
+                                 pickle.dumps(predictor.compiled_state())})
@@ -262,6 +262,7 @@ modules = {
     "tokens": get_tokens,
     "tactics": get_tactics,
     "predict": interactive_predictor.predict,
+    "export": predict_tactic.exportPredictor,
 }
 
 if __name__ == "__main__":
@@ -62,7 +62,7 @@ from models.q_estimator import QEstimator
 from models import features_polyarg_predictor
 import predict_tactic
 import util
-from util import eprint, print_time, unwrap, progn, safe_abbrev
+from util import eprint, print_time, unwrap, progn, safe_abbrev, chunks
 
 from rgraph import (LabeledTransition,
                     ReinforceGraph, assignApproximateQScores)
@@ -874,27 +874,30 @@ def assign_rewards(args: argparse.Namespace,
                    transitions: List[dataloader.ScrapedTransition]) -> \
       List[LabeledTransition]:
     def generate() -> Iterator[LabeledTransition]:
-        for transition in transitions:
-            if len(transition.before.fg_goals) == 0:
-                context = TacticContext(transition.relevant_lemmas,
-                                        transition.prev_tactics,
-                                        [], "")
-            else:
-                context = TacticContext(
-                    transition.relevant_lemmas,
-                    transition.prev_tactics,
-                    transition.before.fg_goals[0].hypotheses,
-                    transition.before.fg_goals[0].goal)
-            yield assign_reward(args,
-                                transition.relevant_lemmas,
-                                transition.prev_tactics,
-                                context_r2py(transition.before),
-                                context_r2py(transition.after),
-                                transition.tactic,
-                                certainty_of(predictor,
-                                             args.num_predictions * 2,
-                                             context,
-                                             transition.tactic))
+        for transitions_chunk in chunks(transitions, args.batch_size):
+            contexts = []
+            for transition in transitions_chunk:
+                if len(transition.before.fg_goals) == 0:
+                    contexts.append(TacticContext(transition.relevant_lemmas,
+                                                  transition.prev_tactics,
+                                                  [], ""))
+                else:
+                    contexts.append(TacticContext(
+                        transition.relevant_lemmas,
+                        transition.prev_tactics,
+                        transition.before.fg_goals[0].hypotheses,
+                        transition.before.fg_goals[0].goal))
+            certainties = certainties_of(
+                predictor, contexts,
+                [transition.tactic for transition in transitions_chunk])
+            for transition, certainty in zip(transitions_chunk, certainties):
+                yield assign_reward(args,
+                                    transition.relevant_lemmas,
+                                    transition.prev_tactics,
+                                    context_r2py(transition.before),
+                                    context_r2py(transition.after),
+                                    transition.tactic,
+                                    certainty)
     return list(generate())
 
 
@@ -1035,6 +1038,15 @@ def certainty_of(predictor: tactic_predictor.TacticPredictor, k: int,
     return predictor.predictionCertainty(context, tactic)
 
 
+def certainties_of(predictor: tactic_predictor.TacticPredictor,
+                   contexts: List[TacticContext],
+                   tactics: List[str]) -> List[float]:
+    predictor = cast(features_polyarg_predictor.
+                     FeaturesPolyargPredictor,
+                     predictor)
+    return predictor.predictionCertainty_batch(contexts, tactics)
+
+
 if __name__ == "__main__":
     tmp.set_start_method('spawn')
     main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+from pathlib import Path
+from typing import List, Optional
+
+import pygraphviz as pgv
+from tqdm import tqdm
+
+trace_suffix = ".trace.jsonl"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=
+        "Render search graph svgs from the json lines traces written "
+        "by searching with --graph-format=trace")
+    parser.add_argument("traces",
+                        help="trace files, or report directories "
+                        "to look for them in",
+                        nargs="+",
+                        type=Path)
+    parser.add_argument("--lemma", dest="lemmas", action="append",
+                        default=None,
+                        help="only render the graphs of lemmas with this "
+                        "name (can be given more than once)")
+    parser.add_argument("-j", "--num-threads", type=int, default=None)
+    parser.add_argument("--progress", "-P", action='store_true')
+    args = parser.parse_args()
+
+    trace_files = find_traces(args.traces, args.lemmas)
+    with multiprocessing.Pool(args.num_threads) as pool:
+        for _ in tqdm(pool.imap_unordered(render_trace, trace_files),
+                      total=len(trace_files), desc="Rendering graphs",
+                      disable=not args.progress):
+            pass
+
+
+def find_traces(paths: List[Path], lemmas: Optional[List[str]]) \
+        -> List[Path]:
+    trace_files: List[Path] = []
+    for path in paths:
+        if path.is_dir():
+            trace_files += sorted(path.glob(f"**/*{trace_suffix}"))
+        else:
+            trace_files.append(path)
+    if lemmas:
+        # Trace files are named by the escaped module prefix, which always
+        # ends in an escaped dot, followed by the lemma name.
+        trace_files = [trace_file for trace_file in trace_files
+                       if any(trace_file.name == lemma + trace_suffix or
+                              trace_file.name.endswith(
+                                  "Zd" + lemma + trace_suffix)
+                              for lemma in lemmas)]
+    return trace_files
+
+
+def render_trace(trace_file: Path) -> None:
+    graph = pgv.AGraph(directed=True)
+    with trace_file.open('r') as f:
+        for line in f:
+            entry = json.loads(line)
+            if "color" in entry:
+                node_handle = graph.get_node(entry["id"])
+                if node_handle.attr["fillcolor"]:
+                    node_handle.attr["fillcolor"] += (":" + entry["color"])
+                else:
+                    node_handle.attr["fillcolor"] = entry["color"]
+                    node_handle.attr["style"] = "filled"
+            else:
+                attrs = entry.get("attrs", {})
+                graph.add_node(entry["id"], label=entry["label"],
+                               tooltip=entry["tooltip"], **attrs)
+                if entry["parent"] is not None:
+                    graph.add_edge(entry["parent"], entry["id"], **attrs)
+    svg_file = trace_file.with_name(
+        trace_file.name[:-len(trace_suffix)] + ".svg")
+    with contextlib.redirect_stderr(io.StringIO()):
+        graph.draw(str(svg_file), prog="dot")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import util
+from search_results import SearchResult
+from search_worker import ReportJob
+
+
+def proofs_file_paths(output_dir: Path, project_dicts: List[Dict[str, Any]]) \
+        -> Dict[Tuple[str, str], Path]:
+    # Maps each (project, filename) to the -proofs.txt file its results go
+    # in. The abbreviation depends on the other files in the project, so
+    # this is worth computing once instead of for every result.
+    # This is the same naming as util.safe_abbrev, but counting the stems
+    # up front so it's linear in the number of files.
+    paths: Dict[Tuple[str, str], Path] = {}
+    for project_dict in project_dicts:
+        filenames = [Path(filename) for filename
+                     in project_dict["test_files"]]
+        stem_counts = Counter(filename.stem for filename in set(filenames))
+        for filename in filenames:
+            if stem_counts[filename.stem] > 1:
+                abbrev = util.escape_filename(str(filename))
+            else:
+                abbrev = filename.stem
+            paths[(project_dict["project_name"], str(filename))] = \
+                output_dir / project_dict["project_name"] / \
+                (abbrev + "-proofs.txt")
+    return paths
+
+
+def proofs_file_for(proofs_files: Dict[Tuple[str, str], Path],
+                    job: ReportJob) -> Path:
+    # Job filenames are normalized the same way as the keys in
+    # proofs_file_paths, so "./foo.v" and "foo.v" find the same file.
+    return proofs_files[(job.project_dir, str(Path(job.filename)))]
+
+
+class ResultsIndex:
+    # An sqlite index of the jobs in the -proofs.txt files (their status,
+    # search time, and where their line starts), so that resuming and
+    # tracking progress don't have to re-parse every serialized solution.
+    #
+    # The proofs files are still the source of truth. The index remembers
+    # how much of each file it has seen, and before answering any question
+    # about a file it indexes whatever has been appended since, whoever
+    # appended it.
+    def __init__(self, index_path: Path) -> None:
+        self.conn = sqlite3.connect(str(index_path), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results "
+                          "(proofs_file TEXT, offset INTEGER, "
+                          " project TEXT, filename TEXT, module TEXT, "
+                          " lemma TEXT, status TEXT, time REAL, "
+                          " PRIMARY KEY (proofs_file, offset))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS indexed_files "
+                          "(proofs_file TEXT PRIMARY KEY, size INTEGER)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _indexed_size(self, proofs_file: Path) -> int:
+        row = self.conn.execute(
+            "SELECT size FROM indexed_files WHERE proofs_file = ?",
+            (str(proofs_file),)).fetchone()
+        return row[0] if row else 0
+
+    def _add_lines(self, proofs_file: Path, start_offset: int,
+                   data: bytes) -> int:
+        # Indexes the complete lines in data, which starts at start_offset in
+        # the file, and returns the file offset after the last one.
+        offset = start_offset
+        entries = []
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            (project, filename, module, lemma), sol = json.loads(line)
+            entries.append((str(proofs_file), offset, project, filename,
+                            module, lemma, sol["status"], sol.get("time")))
+            offset += len(line)
+        self.conn.executemany("INSERT OR REPLACE INTO results "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+        self.conn.execute("INSERT OR REPLACE INTO indexed_files "
+                          "VALUES (?, ?)", (str(proofs_file), offset))
+        return offset
+
+    def sync(self, proofs_file: Path) -> None:
+        with self.lock:
+            indexed_size = self._indexed_size(proofs_file)
+            try:
+                file_size = proofs_file.stat().st_size
+            except FileNotFoundError:
+                file_size = 0
+            if file_size == indexed_size:
+                return
+            if file_size < indexed_size:
+                # The file was removed or rewritten since we indexed it
+                self._forget(proofs_file)
+                indexed_size = 0
+            if file_size > 0:
+                with proofs_file.open('rb') as f:
+                    f.seek(indexed_size)
+                    self._add_lines(proofs_file, indexed_size, f.read())
+            self.conn.commit()
+
+    def append(self, proofs_file: Path, lines: List[str]) -> None:
+        self.sync(proofs_file)
+        data = "".join(lines).encode()
+        with self.lock:
+            with proofs_file.open('ab') as f:
+                f.seek(0, os.SEEK_END)
+                start_offset = f.tell()
+                f.write(data)
+            self._add_lines(proofs_file, start_offset, data)
+            self.conn.commit()
+
+    def _forget(self, proofs_file: Path) -> None:
+        self.conn.execute("DELETE FROM results WHERE proofs_file = ?",
+                          (str(proofs_file),))
+        self.conn.execute("DELETE FROM indexed_files WHERE proofs_file = ?",
+                          (str(proofs_file),))
+
+    def forget(self, proofs_file: Path) -> None:
+        with self.lock:
+            self._forget(proofs_file)
+            self.conn.commit()
+
+    def done_jobs(self, proofs_files: List[Path]) -> List[ReportJob]:
+        done: List[ReportJob] = []
+        for proofs_file in proofs_files:
+            self.sync(proofs_file)
+            with self.lock:
+                done += [ReportJob(*row) for row in self.conn.execute(
+                    "SELECT project, filename, module, lemma FROM results "
+                    "WHERE proofs_file = ? ORDER BY offset",
+                    (str(proofs_file),))]
+        return done
+
+    def jobs_since(self, proofs_file: Path, offset: int) \
+            -> Tuple[List[ReportJob], int]:
+        # The jobs whose lines start at or after offset in proofs_file, and
+        # the offset to pass next time to get only the ones after those. If
+        # the file got shorter since, it was rewritten, so all of its jobs
+        # are returned.
+        self.sync(proofs_file)
+        with self.lock:
+            indexed_size = self._indexed_size(proofs_file)
+            if indexed_size < offset:
+                offset = 0
+            jobs = [ReportJob(*row) for row in self.conn.execute(
+                "SELECT project, filename, module, lemma FROM results "
+                "WHERE proofs_file = ? AND offset >= ? ORDER BY offset",
+                (str(proofs_file), offset))]
+            return jobs, indexed_size
+
+
+def open_results_index(output_dir: Path) -> ResultsIndex:
+    os.makedirs(output_dir, exist_ok=True)
+    return ResultsIndex(output_dir / "results-index.sqlite")
+
+
+class ResultsWriter:
+    # Appends search results to the -proofs.txt files (and the results index)
+    # from a background thread, so the main loop can go straight back to
+    # collecting results. Whatever results have piled up are written
+    # together, opening each file once per batch. If writing fails, the
+    # error is raised from the next call to write or close.
+    def __init__(self, output_dir: Path,
+                 project_dicts: List[Dict[str, Any]]) -> None:
+        self.proofs_files = proofs_file_paths(output_dir, project_dicts)
+        self.index = open_results_index(output_dir)
+        self._error: Optional[BaseException] = None
+        self._results: 'queue.Queue[Optional[Tuple[ReportJob, SearchResult]]]' \
+            = queue.Queue()
+        self._thread = threading.Thread(target=self._write_results,
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> 'ResultsWriter':
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        self.close()
+
+    def write(self, job: ReportJob, sol: SearchResult) -> None:
+        self._raise_error()
+        self._results.put((job, sol))
+
+    def close(self) -> None:
+        self._results.put(None)
+        self._thread.join()
+        self.index.close()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise RuntimeError("Writing search results failed") \
+                from self._error
+
+    def _write_results(self) -> None:
+        try:
+            self._write_batches()
+        except BaseException as e:
+            self._error = e
+
+    def _write_batches(self) -> None:
+        finished = False
+        while not finished:
+            batch = [self._results.get()]
+            while True:
+                try:
+                    batch.append(self._results.get_nowait())
+                except queue.Empty:
+                    break
+            lines_by_file: Dict[Path, List[str]] = {}
+            for item in batch:
+                if item is None:
+                    finished = True
+                    continue
+                job, sol = item
+                proofs_file = proofs_file_for(self.proofs_files, job)
+                lines_by_file.setdefault(proofs_file, []).append(
+                    json.dumps(((job.project_dir, str(job.filename),
+                                 job.module_prefix, job.lemma_statement),
+                                sol.to_dict())) + "\n")
+            for proofs_file, lines in lines_by_file.items():
+                self.index.append(proofs_file, lines)
+
+
+def shard_files(output_dir: Path) -> List[Path]:
+    return sorted((output_dir / "shards").glob("*-proofs.txt"))
+
+
+class DoneJobCounter:
+    # Counts the finished jobs in each project while cluster workers run.
+    # The proofs files are only read when it's created, since the workers
+    # only append to their shards; after that, each update reads just what
+    # was appended to each shard since the last one. Jobs are counted once,
+    # even when a job whose lease expired ends up in more than one shard.
+    def __init__(self, index: ResultsIndex, output_dir: Path,
+                 proofs_files: List[Path]) -> None:
+        self.index = index
+        self.output_dir = output_dir
+        self.done_jobs = set(index.done_jobs(proofs_files))
+        self.project_done = Counter(job.project_dir
+                                    for job in self.done_jobs)
+        self.shard_offsets: Dict[Path, int] = {}
+        self.update()
+
+    @property
+    def num_done(self) -> int:
+        return len(self.done_jobs)
+
+    def update(self) -> None:
+        for shard_file in shard_files(self.output_dir):
+            new_jobs, self.shard_offsets[shard_file] = self.index.jobs_since(
+                shard_file, self.shard_offsets.get(shard_file, 0))
+            for job in new_jobs:
+                if job not in self.done_jobs:
+                    self.done_jobs.add(job)
+                    self.project_done[job.project_dir] += 1
+
+
+class ShardWriter:
+    # Cluster workers each append their results to their own shard file, so
+    # they don't contend for locks on the shared proofs files. Writes are
+    # buffered, and only flushed every flush_interval seconds; write returns
+    # True when it flushed, so the caller knows which results have made it
+    # to disk.
+    def __init__(self, shard_file: Path, flush_interval: float = 60) -> None:
+        os.makedirs(shard_file.parent, exist_ok=True)
+        self.file = shard_file.open('a')
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+    def write(self, job: ReportJob, sol: SearchResult) -> bool:
+        self.file.write(json.dumps((job, sol.to_dict())) + "\n")
+        if time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+            return True
+        return False
+
+    def flush(self) -> None:
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def merge_result_shards(output_dir: Path,
+                        project_dicts: List[Dict[str, Any]]) -> None:
+    # Moves the results in the cluster workers' shards into the proofs file
+    # for their source file. Jobs that are already in the proofs files (for
+    # instance, because a job was run again after its lease expired, or an
+    # earlier merge was interrupted) are skipped.
+    proofs_files = proofs_file_paths(output_dir, project_dicts)
+    index = open_results_index(output_dir)
+    merged_jobs = set(index.done_jobs(list(proofs_files.values())))
+    for shard_file in shard_files(output_dir):
+        lines_by_file: Dict[Path, List[str]] = {}
+        with shard_file.open('r') as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                job = ReportJob(*json.loads(line)[0])
+                if job in merged_jobs:
+                    continue
+                merged_jobs.add(job)
+                lines_by_file.setdefault(proofs_file_for(proofs_files, job),
+                                         []).append(line)
+        for proofs_file, lines in lines_by_file.items():
+            index.append(proofs_file, lines)
+        os.remove(shard_file)
+        index.forget(shard_file)
+    index.close()
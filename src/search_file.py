@@ -49,6 +49,14 @@ from util import eprint
 import search_report
 from search_results import SearchResult
 from search_worker import ReportJob, Worker, get_files_jobs
+from job_scheduling import (chunk_jobs_by_file, estimate_job_costs,
+                            load_proof_times)
+from results_writer import (ResultsWriter, open_results_index,
+                            proofs_file_paths, shard_files)
+from inference_server import start_inference_server, stop_inference_server
+import search_strategies
+from search_strategies import (FailedTacticCache, load_failed_tactics,
+                               save_failed_tactics)
 import multi_project_report
 import util
 
@@ -107,6 +115,9 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--search-depth", type=int, default=6)
     parser.add_argument("--astar-steps", type=int, default=1024)
     parser.add_argument("--beam-width", type=int, default=16)
+    parser.add_argument("--batch-beam-predictions", action='store_true',
+                        help="In beam search, predict tactics for a whole "
+                        "beam level with one batched model call")
     parser.add_argument("--hard-depth-limit", dest="hard_depth_limit",
                         type=int, default=100)
     parser.add_argument("--max-subgoals", type=int, default=16)
@@ -123,7 +134,14 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
                         type=float, default=300)
     parser.add_argument("--max-tactic-time", type=float, default=2)
     parser.add_argument("--linearize", action='store_true')
-    parser.add_argument("--proof-times", default=None, type=Path)
+    parser.add_argument("--proof-times", default=None, type=Path,
+                        help="A previous report directory (or -proofs.txt "
+                        "file) to estimate how long each lemma takes from, "
+                        "so that the longest jobs can be started first")
+    parser.add_argument("--file-chunk-size", type=int, default=0,
+                        help="The most lemmas from one file to give a worker "
+                        "at a time (by default, enough to make a couple of "
+                        "chunks per worker)")
     parser.add_argument('filenames', help="proof file name (*.v)",
                         nargs='+', type=Path)
     parser.add_argument("--splits-file", default=None, type=Path)
@@ -138,6 +156,10 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
                         dest="count_failing_predictions")
     parser.add_argument('--count-softfail-predictions', action='store_true',
                         dest="count_softfail_predictions")
+    parser.add_argument("--no-transposition-table", dest="transposition_table",
+                        action='store_false',
+                        help="Don't prune proof states that were already "
+                        "reached through a different sequence of tactics")
     parser.add_argument("--careful", action='store_true')
     parser.add_argument("--relevant-lemmas", dest="relevant_lemmas",
                         choices=['local', 'hammer', 'searchabout'],
@@ -160,7 +182,38 @@ def add_args_to_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("--tokens-file", type=Path, default=Path("tokens.txt"))
     parser.add_argument("--beta-file", type=Path, default=Path("beta.txt"))
     parser.add_argument("--features-json", action='store_true')
+    parser.add_argument("--graph-format", choices=["svg", "trace"],
+                        default="svg",
+                        help="Draw search graphs as svgs while searching, or "
+                        "stream them to json lines traces that can be "
+                        "rendered later with render_search_graphs.py")
     parser.add_argument("--search-prefix", type=str, default=None)
+    parser.add_argument("--failed-tactic-cache", type=Path, default=None,
+                        help="File of tactics known to fail in a given proof "
+                        "state after a given file prefix, loaded before "
+                        "searching and saved after, so they aren't sent to "
+                        "Coq again")
+    parser.add_argument("--warm-sertops", type=int, default=0,
+                        help="How many spare sertop instances each worker "
+                        "keeps starting in the background, to swap in when "
+                        "it has to restart Coq")
+    parser.add_argument("--quantize", action='store_true',
+                        help="Run the predictor's model with dynamic int8 "
+                        "quantization, for faster CPU-only search")
+    parser.add_argument("--prediction-cache-size", type=int, default=100000,
+                        help="How many hypothesis scores, and tokenized and "
+                        "featurized premises, the predictor keeps around "
+                        "between predictions (0 to disable)")
+    parser.add_argument("--inference-server", action='store_true',
+                        help="Run the model in a single process that batches "
+                        "together the predictions of all the search workers, "
+                        "instead of giving each device its own copy")
+    parser.add_argument("--inference-batch-window", type=float, default=0.01,
+                        help="How long (in seconds) the inference server "
+                        "waits for more requests before running a batch")
+    parser.add_argument("--inference-max-batch", type=int, default=64,
+                        help="The most proof states the inference server "
+                        "will put in one batch")
 
 def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
                                                    List[str],
@@ -188,6 +241,9 @@ def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
 def get_predictor(parser: argparse.ArgumentParser,
                   args: argparse.Namespace) -> TacticPredictor:
     predictor: TacticPredictor
+    if args.quantize and util.use_cuda:
+        parser.error("--quantize is only supported for CPU-only search, "
+                     "but CUDA is available")
     if args.weightsfile:
         predictor = loadPredictorByFile(args.weightsfile)
     elif args.predictor:
@@ -196,6 +252,14 @@ def get_predictor(parser: argparse.ArgumentParser,
         print("You must specify either --weightsfile or --predictor!")
         parser.print_help()
         sys.exit(1)
+    if args.quantize:
+        if not predictor.can_quantize():
+            parser.error(f"--quantize isn't supported for this predictor. "
+                         "Only uncompiled polyarg predictors can be quantized "
+                         "at load time; compiled ones are quantized by "
+                         "passing --quantize when exporting them")
+        predictor.quantize()
+    predictor.set_cache_size(args.prediction_cache_size)
     return predictor
 
 
@@ -203,30 +267,36 @@ def search_file_worker_profiled(
         args: argparse.Namespace,
         predictor: TacticPredictor,
         predictor_lock: threading.Lock,
-        jobs: 'multiprocessing.Queue[Tuple[str, str, str]]',
+        jobs: 'multiprocessing.Queue[List[ReportJob]]',
         done:
         'multiprocessing.Queue['
-        '  Tuple[Tuple[str, str, str], SearchResult]]',
+        '  Tuple[ReportJob, SearchResult]]',
         worker_idx: int,
-        device: str) -> None:
+        device: str,
+        failed_tactics: Optional[Dict] = None) -> None:
     cProfile.runctx('search_file_worker(args, predictor, '
-                    'predictor_lock, jobs, done, worker_idx, device)',
+                    'predictor_lock, jobs, done, worker_idx, device, '
+                    'failed_tactics)',
                     globals(), locals(), 'searchstats-{}'.format(worker_idx))
 
 def search_file_worker(args: argparse.Namespace,
                        predictor: TacticPredictor,
                        predictor_lock: threading.Lock,
-                       jobs: 'multiprocessing.Queue[ReportJob]',
+                       jobs: 'multiprocessing.Queue[List[ReportJob]]',
                        done:
                        'multiprocessing.Queue['
                        '  Tuple[ReportJob, SearchResult]]',
                        worker_idx: int,
-                       device: str) -> None:
+                       device: str,
+                       failed_tactics: Optional[Dict] = None) -> None:
     sys.setrecursionlimit(100000)
     # util.use_cuda = False
     if util.use_cuda:
         torch.cuda.set_device(device) # type: ignore
     util.cuda_device = device
+    if failed_tactics is not None:
+        search_strategies.failed_tactic_cache = \
+            FailedTacticCache(failed_tactics)
 
     if args.splits_file:
         with args.splits_file.open('r') as f:
@@ -242,11 +312,12 @@ def search_file_worker(args: argparse.Namespace,
     with Worker(args, worker_idx, predictor, switch_dict) as worker:
         while True:
             try:
-                next_job = jobs.get_nowait()
+                next_chunk = jobs.get_nowait()
             except queue.Empty:
                 return
-            solution = worker.run_job(next_job, restart=not args.hardfail)
-            done.put((next_job, solution))
+            for next_job in next_chunk:
+                solution = worker.run_job(next_job, restart=not args.hardfail)
+                done.put((next_job, solution))
 
 def project_dicts_from_args(args: argparse.Namespace) -> List[Dict[str, Any]]:
     if args.splits_file:
@@ -258,28 +329,16 @@ def project_dicts_from_args(args: argparse.Namespace) -> List[Dict[str, Any]]:
     return project_dicts
 
 def get_already_done_jobs(args: argparse.Namespace) -> List[ReportJob]:
-    already_done_jobs: List[ReportJob] = []
-
-    project_dicts = project_dicts_from_args(args)
-    for project_dict in project_dicts:
-        for filename in project_dict["test_files"]:
-            proofs_file = (args.output_dir / project_dict["project_name"] /
-                           (util.safe_abbrev(Path(filename),
-                                             [Path(filename) for filename in
-                                              project_dict["test_files"]])
-                            + "-proofs.txt"))
-            try:
-                with proofs_file.open('r') as f:
-                    for line in f:
-                        (job_project, job_file, job_module, job_lemma), sol = json.loads(line)
-                        already_done_jobs.append(ReportJob(job_project,
-                                                           job_file,
-                                                           job_module,
-                                                           job_lemma))
-            except FileNotFoundError:
-                pass
-
-    return already_done_jobs
+    # Cluster workers write to their own shards until they're merged, and a
+    # job can end up in more than one place if it was run twice.
+    index = open_results_index(args.output_dir)
+    try:
+        return list(dict.fromkeys(index.done_jobs(
+            list(proofs_file_paths(
+                args.output_dir, project_dicts_from_args(args)).values()) +
+            shard_files(args.output_dir))))
+    finally:
+        index.close()
 
 def get_all_jobs(args: argparse.Namespace) -> List[ReportJob]:
     project_dicts = project_dicts_from_args(args)
@@ -289,18 +348,16 @@ def get_all_jobs(args: argparse.Namespace) -> List[ReportJob]:
     return list(get_files_jobs(args, tqdm(proj_filename_tuples, desc="Getting jobs")))
 
 def remove_already_done_jobs(args: argparse.Namespace) -> None:
-    project_dicts = project_dicts_from_args(args)
-    for project_dict in project_dicts:
-        for filename in project_dict["test_files"]:
-            proofs_file = (args.output_dir / project_dict["project_name"] /
-                           (util.safe_abbrev(Path(filename),
-                                             [Path(filename) for filename in
-                                              project_dict["test_files"]])
-                            + "-proofs.txt"))
-            try:
-                os.remove(proofs_file)
-            except FileNotFoundError:
-                pass
+    index = open_results_index(args.output_dir)
+    for proofs_file in list(proofs_file_paths(
+            args.output_dir, project_dicts_from_args(args)).values()) + \
+            shard_files(args.output_dir):
+        try:
+            os.remove(proofs_file)
+        except FileNotFoundError:
+            pass
+        index.forget(proofs_file)
+    index.close()
 
 def search_file_multithreaded(args: argparse.Namespace,
                               predictor: TacticPredictor) -> None:
@@ -324,21 +381,29 @@ def search_file_multithreaded(args: argparse.Namespace,
         remove_already_done_jobs(args)
         solved_jobs = []
     all_jobs = get_all_jobs(args)
-    todo_jobs = [job for job in all_jobs if job not in solved_jobs]
+    solved_jobs_set = set(solved_jobs)
+    todo_jobs = [job for job in all_jobs if job not in solved_jobs_set]
     assert len(todo_jobs) == len(all_jobs) - len(solved_jobs),\
       f"{len(todo_jobs)} != {len(all_jobs)} - {len(solved_jobs)}"
     with multiprocessing.Manager() as manager:
-        jobs: multiprocessing.Queue[ReportJob] = multiprocessing.Queue()
+        jobs: multiprocessing.Queue[List[ReportJob]] = multiprocessing.Queue()
         done: multiprocessing.Queue[
             Tuple[ReportJob, SearchResult]
         ] = multiprocessing.Queue()
 
-
-        for job in todo_jobs:
-            jobs.put(job)
+        if args.proof_times:
+            job_costs: Optional[Dict[ReportJob, float]] = estimate_job_costs(
+                todo_jobs, load_proof_times(args.proof_times,
+                                            args.max_search_time_per_lemma))
+        else:
+            job_costs = None
+        job_chunks = chunk_jobs_by_file(todo_jobs, args.num_threads,
+                                        args.file_chunk_size, job_costs)
+        for chunk in job_chunks:
+            jobs.put(chunk)
 
         num_threads = min(args.num_threads,
-                          len(todo_jobs))
+                          len(job_chunks))
         if util.use_cuda:
             if args.gpus:
                 gpu_list = args.gpus.split(",")
@@ -349,22 +414,37 @@ def search_file_multithreaded(args: argparse.Namespace,
         else:
             assert args.gpus is None, "Passed --gpus flag, but CUDA is not supported!"
             worker_devices = ["cpu"]
-        worker_predictors = [copy.deepcopy(predictor)
-                             for device in worker_devices]
-        for predictor, device in zip(worker_predictors, worker_devices):
-            predictor.to_device(device) # type: ignore
-            predictor.share_memory() # type: ignore
+        # With nothing left to run there are no devices to place a
+        # server on, and no workers for it to serve
+        use_inference_server = args.inference_server and num_threads > 0
+        if use_inference_server:
+            predictor.to_device(worker_devices[0]) # type: ignore
+            inference_process, worker_predictors = start_inference_server(
+                predictor, worker_devices[0], num_threads,
+                args.inference_batch_window, args.inference_max_batch)
+        else:
+            worker_predictors = [copy.deepcopy(predictor)
+                                 for device in worker_devices]
+            for predictor, device in zip(worker_predictors, worker_devices):
+                predictor.to_device(device) # type: ignore
+                predictor.share_memory() # type: ignore
         # This cast appears to be needed due to a buggy type stub on
         # multiprocessing.Manager()
         predictor_locks = [cast(multiprocessing.managers.SyncManager,
                                 manager).Lock()
                            for predictor in worker_predictors]
+        if args.failed_tactic_cache:
+            failed_tactics = manager.dict(
+                load_failed_tactics(args.failed_tactic_cache))
+        else:
+            failed_tactics = None
         workers = [multiprocessing.Process(target=search_file_worker,
                                            args=(args,
                                                  worker_predictors[widx % len(worker_predictors)],
                                                  predictor_locks[widx % len(worker_predictors)],
                                                  jobs, done, widx,
-                                                 worker_devices[widx % len(worker_predictors)]))
+                                                 worker_devices[widx % len(worker_devices)],
+                                                 failed_tactics))
                    for widx in range(num_threads)]
         for worker in workers:
             worker.start()
@@ -372,32 +452,23 @@ def search_file_multithreaded(args: argparse.Namespace,
         os.makedirs(args.output_dir, exist_ok=True)
         with util.sighandler_context(signal.SIGINT, functools.partial(handle_interrupt, args)):
             with tqdm(total=len(todo_jobs) + num_already_done,
-                      dynamic_ncols=True, desc="Searching proofs") as bar:
+                      dynamic_ncols=True, desc="Searching proofs") as bar, \
+                 ResultsWriter(args.output_dir,
+                               project_dicts_from_args(args)) as writer:
                 bar.update(n=num_already_done)
                 bar.refresh()
                 for _ in range(len(todo_jobs)):
-                    (done_project, done_file, done_module, done_lemma), sol = done.get()
-                    if args.splits_file:
-                        with args.splits_file.open('r') as splits_f:
-                            project_dicts = json.loads(splits_f.read())
-                        for project_dict in project_dicts:
-                            if project_dict["project_name"] == done_project:
-                                filenames = [Path(fname) for fname in project_dict["test_files"]]
-                                break
-                    else:
-                        filenames = args.filenames
-                    proofs_file = (args.output_dir / done_project /
-                                   (util.safe_abbrev(Path(done_file),
-                                                     filenames)
-                                    + "-proofs.txt"))
-                    with proofs_file.open('a') as f:
-                        f.write(json.dumps(((done_project, str(done_file), done_module, done_lemma),
-                                            sol.to_dict())))
-                        f.write("\n")
+                    done_job, sol = done.get()
+                    writer.write(done_job, sol)
                     bar.update()
 
             for worker in workers:
                 worker.join()
+        if use_inference_server:
+            stop_inference_server(inference_process, worker_predictors)
+        if failed_tactics is not None:
+            save_failed_tactics(args.failed_tactic_cache,
+                                dict(failed_tactics))
     time_taken = datetime.now() - start_time
     write_time(args)
     if args.generate_report:
@@ -25,7 +25,6 @@ import os
 import time
 import sys
 import json
-import subprocess
 import signal
 import shutil
 import functools
@@ -33,12 +32,18 @@ from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime, timedelta
 
-from typing import List, NamedTuple
+from collections import Counter
+from typing import List, NamedTuple, Dict
 
 from search_file import (add_args_to_parser, get_predictor,
                          get_already_done_jobs, remove_already_done_jobs,
                          project_dicts_from_args)
 from search_worker import ReportJob
+from job_queue import JobQueue
+from search_strategies import merge_failed_tactic_shards
+from results_writer import (DoneJobCounter, merge_result_shards,
+                            open_results_index, proofs_file_paths)
+from cluster_dispatch import Dispatcher, get_dispatcher
 from search_report import generate_report
 import coq_serapy
 import util
@@ -58,6 +63,14 @@ def main(arg_list: List[str]) -> None:
     arg_parser.add_argument("--worker-timeout", default="6:00:00")
     arg_parser.add_argument("-p", "--partition", default="defq")
     arg_parser.add_argument("--mem", default="2G")
+    arg_parser.add_argument("--dispatcher", choices=["slurm", "local"],
+                            default="slurm",
+                            help="Run workers on a SLURM cluster, or as "
+                            "processes on this machine")
+    arg_parser.add_argument("--job-lease-time", default=600, type=float,
+                            help="How long (in seconds) a worker can go "
+                            "without checking in on a job before other "
+                            "workers assume it crashed and take the job")
 
     args = arg_parser.parse_args(arg_list)
     if args.filenames[0].suffix == ".json":
@@ -66,6 +79,7 @@ def main(arg_list: List[str]) -> None:
         args.splits_file = args.filenames[0]
         args.filenames = []
     predictor = get_predictor(arg_parser, args)
+    dispatcher = get_dispatcher(args)
     base = Path(os.path.dirname(os.path.abspath(__file__)))
 
     os.makedirs(str(args.output_dir), exist_ok=True)
@@ -109,27 +123,33 @@ def main(arg_list: List[str]) -> None:
         remove_already_done_jobs(args)
         solved_jobs = []
     os.makedirs(str(args.output_dir / args.workers_output_dir), exist_ok=True)
-    get_all_jobs_cluster(args)
+    get_all_jobs_cluster(args, dispatcher)
     with open(args.output_dir / "all_jobs.txt") as f:
         jobs = [ReportJob(*json.loads(line)) for line in f]
         assert len(jobs) > 0
     if len(solved_jobs) < len(jobs):
         setup_jobsstate(args.output_dir, jobs, solved_jobs)
-        dispatch_workers(args, arg_list)
-        with util.sighandler_context(signal.SIGINT, functools.partial(interrupt_early, args)):
+        dispatch_workers(args, dispatcher, arg_list)
+        with util.sighandler_context(signal.SIGINT,
+                                     functools.partial(interrupt_early, args,
+                                                       dispatcher)):
             show_progress(args)
-        cancel_workers(args)
+        cancel_workers(dispatcher)
         with open(args.output_dir / "time_so_far.txt", 'w') as f:
             time_taken = datetime.now() - start_time
             print(str(time_taken), file=f)
     else:
         assert len(solved_jobs) == len(jobs), f"There are {len(solved_jobs)} solved jobs but only {len(jobs)} jobs total detected"
+    merge_result_shards(args.output_dir, project_dicts_from_args(args))
+    if args.failed_tactic_cache:
+        merge_failed_tactic_shards(args.failed_tactic_cache)
     if args.generate_report:
         generate_report(args, predictor, project_dicts_from_args(args), time_taken)
 
 
 
-def get_all_jobs_cluster(args: argparse.Namespace) -> None:
+def get_all_jobs_cluster(args: argparse.Namespace,
+                         dispatcher: Dispatcher) -> None:
     if (args.output_dir / "all_jobs.txt").exists():
         return
     project_dicts = project_dicts_from_args(args)
@@ -157,12 +177,9 @@ def get_all_jobs_cluster(args: argparse.Namespace) -> None:
         worker_args.append(f"--proof={args.proof}")
     elif args.proofs_file:
         worker_args.append(f"--proofs-file={str(args.proofs_file)}")
-    cur_dir = os.path.realpath(os.path.dirname(__file__))
-    subprocess.run([f"{cur_dir}/sbatch-retry.sh",
-                    "-o", str(args.output_dir / args.workers_output_dir /
-                              "file-scanner-%a.out"),
-                    f"--array=0-{args.num_workers-1}",
-                    f"{cur_dir}/job_getting_worker.sh"] + worker_args)
+    dispatcher.dispatch("job_getting_worker", worker_args, args.num_workers,
+                        args.output_dir / args.workers_output_dir /
+                        "file-scanner-%a.out")
 
     with tqdm(desc="Getting jobs", total=len(projfiles), dynamic_ncols=True) as bar:
         num_files_scanned = 0
@@ -176,59 +193,71 @@ def get_all_jobs_cluster(args: argparse.Namespace) -> None:
 
 def setup_jobsstate(output_dir: Path, all_jobs: List[ReportJob],
                     solved_jobs: List[ReportJob]) -> None:
-    with (output_dir / "taken.txt").open("w") as f:
-        pass
-    with (output_dir / "jobs.txt").open("w") as f:
-        for job in all_jobs:
-            if job not in solved_jobs:
-                print(json.dumps(job), file=f)
-        print("", end="", flush=True, file=f)
-def dispatch_workers(args: argparse.Namespace, rest_args: List[str]) -> None:
+    solved_jobs_set = set(solved_jobs)
+    JobQueue.setup(output_dir, [job for job in all_jobs
+                                if job not in solved_jobs_set])
+def dispatch_workers(args: argparse.Namespace, dispatcher: Dispatcher,
+                     rest_args: List[str]) -> None:
     with (args.output_dir / "num_workers_dispatched.txt").open("w") as f:
         print(args.num_workers, file=f)
     with (args.output_dir / "workers_scheduled.txt").open("w") as f:
         pass
-    cur_dir = os.path.realpath(os.path.dirname(__file__))
-    # If you have a different cluster management software, that still allows
-    # dispatching jobs through the command line and uses a shared filesystem,
-    # modify this line.
-    subprocess.run([f"{cur_dir}/sbatch-retry.sh",
-                    "-J", "proverbot9001-worker",
-                    "-p", args.partition,
-                    "-t", str(args.worker_timeout),
-                    "--cpus-per-task", str(args.num_threads),
-                    "-o", str(args.output_dir / args.workers_output_dir
-                              / "worker-%a.out"),
-                    "--mem", args.mem,
-                    f"--array=0-{args.num_workers-1}",
-                    f"{cur_dir}/search_file_cluster_worker.sh"] + rest_args)
-
-def interrupt_early(args: argparse.Namespace, *rest_args) -> None:
-    cancel_workers(args)
+    dispatcher.dispatch("search_file_cluster_worker", rest_args,
+                        args.num_workers,
+                        args.output_dir / args.workers_output_dir
+                        / "worker-%a.out",
+                        job_name="proverbot9001-worker",
+                        num_cpus=args.num_threads,
+                        partition=args.partition,
+                        timeout=str(args.worker_timeout),
+                        mem=args.mem)
+def interrupt_early(args: argparse.Namespace, dispatcher: Dispatcher,
+                    *rest_args) -> None:
+    cancel_workers(dispatcher)
     with open(args.output_dir / "time_so_far.txt", 'w') as f:
         time_taken = datetime.now() - start_time
         print(str(time_taken), file=f)
     sys.exit()
-def cancel_workers(args: argparse.Namespace) -> None:
-    subprocess.run(["scancel -u $USER -n proverbot9001-worker"], shell=True)
+def cancel_workers(dispatcher: Dispatcher) -> None:
+    dispatcher.cancel("proverbot9001-worker")
 
 def show_progress(args: argparse.Namespace) -> None:
-    num_jobs_done = len(get_already_done_jobs(args))
+    index = open_results_index(args.output_dir)
+    proofs_files = list(proofs_file_paths(
+        args.output_dir, project_dicts_from_args(args)).values())
     with (args.output_dir / "all_jobs.txt").open('r') as f:
-        num_jobs_total = len([line for line in f])
+        project_totals = Counter(json.loads(line)[0] for line in f)
+    num_jobs_total = sum(project_totals.values())
+    done_counter = DoneJobCounter(index, args.output_dir, proofs_files)
+    project_done_start = dict(done_counter.project_done)
+    num_jobs_done = done_counter.num_done
     with (args.output_dir / "num_workers_dispatched.txt").open('r') as f:
         num_workers_total = int(f.read())
     with (args.output_dir / "workers_scheduled.txt").open('r') as f:
         num_workers_scheduled = len([line for line in f])
 
+    progress_start = time.time()
+    last_report_time = progress_start
     with tqdm(desc="Jobs finished", total=num_jobs_total,
               initial=num_jobs_done, dynamic_ncols=True) as bar, \
          tqdm(desc="Workers scheduled", total=num_workers_total,
               initial=num_workers_scheduled, dynamic_ncols=True) as wbar:
         while num_jobs_done < num_jobs_total:
-            new_jobs_done = len(get_already_done_jobs(args))
-            bar.update(new_jobs_done - num_jobs_done)
-            num_jobs_done = new_jobs_done
+            done_counter.update()
+            bar.update(done_counter.num_done - num_jobs_done)
+            num_jobs_done = done_counter.num_done
+
+            minutes_elapsed = (time.time() - progress_start) / 60
+            jobs_per_minute = \
+                (num_jobs_done - sum(project_done_start.values())) / \
+                max(minutes_elapsed, 1e-6)
+            bar.set_postfix_str(f"{jobs_per_minute:.1f} jobs/min")
+            if time.time() - last_report_time > 10:
+                write_progress_report(args.output_dir / "progress.txt",
+                                      project_totals, project_done_start,
+                                      done_counter.project_done,
+                                      minutes_elapsed)
+                last_report_time = time.time()
 
             with (args.output_dir / "workers_scheduled.txt").open('r') as f:
                 new_workers_scheduled = len([line for line in f])
@@ -236,6 +265,28 @@ def show_progress(args: argparse.Namespace) -> None:
             num_workers_scheduled = new_workers_scheduled
 
             time.sleep(0.2)
+    index.close()
+
+def write_progress_report(path: Path, project_totals: Dict[str, int],
+                          project_done_start: Dict[str, int],
+                          project_done: Dict[str, int],
+                          minutes_elapsed: float) -> None:
+    with path.open('w') as f:
+        print(f"{'project':<40} {'done':>15} {'jobs/min':>10} {'eta':>10}",
+              file=f)
+        for project, total in sorted(project_totals.items()):
+            done = project_done.get(project, 0)
+            jobs_per_minute = (done - project_done_start.get(project, 0)) / \
+                max(minutes_elapsed, 1e-6)
+            if done >= total:
+                eta = "done"
+            elif jobs_per_minute > 0:
+                eta = str(timedelta(minutes=(total - done) / jobs_per_minute))\
+                    .split(".")[0]
+            else:
+                eta = "?"
+            print(f"{project:<40} {f'{done}/{total}':>15} "
+                  f"{jobs_per_minute:>10.1f} {eta:>10}", file=f)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -34,6 +34,12 @@ from pathlib import Path
 import torch
 
 from search_file import (add_args_to_parser, get_predictor, Worker)
+from search_worker import ReportJob
+from job_queue import JobQueue
+import search_strategies
+from search_strategies import (FailedTacticCache, load_failed_tactics,
+                               save_failed_tactics)
+from results_writer import ShardWriter
 import coq_serapy
 from coq_serapy.contexts import ProofContext
 from models.tactic_predictor import TacticPredictor
@@ -51,6 +57,9 @@ def main(arg_list: List[str]) -> None:
     arg_parser.add_argument("--worker-timeout", default="6:00:00")
     arg_parser.add_argument("-p", "--partition", default="defq")
     arg_parser.add_argument("--mem", default="2G")
+    arg_parser.add_argument("--dispatcher", choices=["slurm", "local"],
+                            default="slurm")
+    arg_parser.add_argument("--job-lease-time", default=600, type=float)
     args = arg_parser.parse_args(arg_list)
     if args.filenames[0].suffix == ".json":
         assert args.splits_file == None
@@ -72,7 +81,7 @@ def main(arg_list: List[str]) -> None:
     with (args.output_dir / "workers_scheduled.txt").open('a') as f, FileLock(f):
         print(workerid, file=f)
     workers = [multiprocessing.Process(target=run_worker,
-                                       args=(args, widx,
+                                       args=(args, workerid, widx,
                                              predictor))
                for widx in range(args.num_threads)]
     for worker in workers:
@@ -81,10 +90,26 @@ def main(arg_list: List[str]) -> None:
         worker.join()
     eprint(f"Finished worker {workerid}")
 
-def run_worker(args: argparse.Namespace, workerid: int,
+def run_worker(args: argparse.Namespace, workerid: int, widx: int,
                predictor: TacticPredictor) -> None:
-    with (args.output_dir / "jobs.txt").open('r') as f:
-        all_jobs = [json.loads(line) for line in f]
+    job_queue = JobQueue(args.output_dir, args.job_lease_time,
+                         workerid * args.num_threads + widx,
+                         args.num_workers * args.num_threads)
+    shard = ShardWriter(args.output_dir / "shards" /
+                        f"{workerid}-{widx}-proofs.txt")
+    # There's no manager process shared between cluster workers, so each one
+    # starts from the cache file, and saves the failures it finds to its own
+    # shard next to it whenever it flushes its results.
+    if args.failed_tactic_cache:
+        failed_tactics_shard = args.failed_tactic_cache.with_name(
+            f"{args.failed_tactic_cache.name}.shard-{workerid}-{widx}")
+        search_strategies.failed_tactic_cache = \
+            FailedTacticCache(load_failed_tactics(args.failed_tactic_cache))
+
+    def save_failures() -> None:
+        if search_strategies.failed_tactic_cache:
+            save_failed_tactics(failed_tactics_shard,
+                                search_strategies.failed_tactic_cache.recorded)
 
     if args.splits_file:
         with args.splits_file.open('r') as f:
@@ -93,27 +118,29 @@ def run_worker(args: argparse.Namespace, workerid: int,
             switch_dict = {item["project_name"]: item["switch"]
                            for item in project_dicts}
 
-    with Worker(args, workerid, predictor, switch_dict) as worker:
+    # Jobs are only marked done once their results are flushed to the
+    # shard, so if this worker dies they'll be run again. Their claims are
+    # kept alive until then.
+    unflushed_job_idxs: List[int] = []
+    with job_queue, Worker(args, widx, predictor, switch_dict) as worker:
         while True:
-            with (args.output_dir / "taken.txt").open('r+') as f, FileLock(f):
-                taken_jobs = [json.loads(line) for line in f]
-                current_job = None
-                for job in all_jobs:
-                    if job not in taken_jobs:
-                        current_job = job
-                        break
-                if current_job:
-                    print(json.dumps(current_job), file=f, flush=True)
-                    eprint(f"Starting job {current_job}")
-                else:
-                    break
-            solution = worker.run_job(current_job)
-            job_project, job_file, _, _ = current_job
-            with (args.output_dir / job_project /
-                  (util.safe_abbrev(Path(job_file), args.filenames) + "-proofs.txt")
-                  ).open('a') as f, FileLock(f):
-                eprint(f"Finished job {current_job}")
-                print(json.dumps((current_job, solution.to_dict())), file=f)
+            claimed = job_queue.claim()
+            if claimed is None:
+                break
+            job_idx, current_job = claimed
+            eprint(f"Starting job {current_job}")
+            solution = worker.run_job(ReportJob(*current_job))
+            eprint(f"Finished job {current_job}")
+            unflushed_job_idxs.append(job_idx)
+            if shard.write(current_job, solution):
+                save_failures()
+                for flushed_idx in unflushed_job_idxs:
+                    job_queue.finish(flushed_idx)
+                unflushed_job_idxs = []
+        shard.close()
+        save_failures()
+        for flushed_idx in unflushed_job_idxs:
+            job_queue.finish(flushed_idx)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -36,6 +36,8 @@ class TacticInteraction(NamedTuple):
 class SearchResult(NamedTuple):
     status: SearchStatus
     commands: Optional[List[TacticInteraction]]
+    # How long the search took, in seconds. Older reports don't have this.
+    time: Optional[float] = None
 
     @classmethod
     def from_dict(cls, data):
@@ -45,12 +47,13 @@ class SearchResult(NamedTuple):
         else:
             commands = list(map(TacticInteraction.from_dict,
                                 data['commands']))
-        return cls(status, commands)
+        return cls(status, commands, data.get('time'))
 
     def to_dict(self):
         return {'status': self.status.name,
                 'commands': list(map(TacticInteraction.to_dict,
-                                     self.commands))}
+                                     self.commands)),
+                'time': self.time}
 
 class VernacBlock(NamedTuple):
     commands: List[str]
@@ -7,7 +7,11 @@ import sys
 import pickle
 import heapq
 import math
-from typing import Dict, List, Tuple, Optional, IO, NamedTuple, cast
+import hashlib
+import glob
+import os
+from typing import (Dict, List, Tuple, Optional, IO, NamedTuple, cast,
+                    Mapping, MutableMapping, Sequence, Set)
 from dataclasses import dataclass, field
 from pathlib import Path
 
@@ -97,6 +101,27 @@ class FeaturesExtractor:
         return [self._num_tactics, self._num_tokens * 2 + 2], [1.0]
 
 
+def write_trace_node(trace: IO[str], node_id: int, parent_id: Optional[int],
+                     label: str, tooltip: str, attrs: Dict[str, str]) -> None:
+    print(json.dumps({"id": node_id, "parent": parent_id,
+                      "label": label, "tooltip": tooltip,
+                      **({"attrs": attrs} if attrs else {})}),
+          file=trace)
+
+
+def write_trace_color(trace: IO[str], node_id: int, color: str) -> None:
+    print(json.dumps({"id": node_id, "color": color}), file=trace)
+
+
+def search_graph_path(output_dir: Path, module_prefix: Optional[str],
+                      lemma_name: str, args: argparse.Namespace) -> Path:
+    if args.graph_format == "trace":
+        suffix = ".trace.jsonl"
+    else:
+        suffix = ".svg"
+    return Path(f"{output_dir}/{module_prefix}{lemma_name}{suffix}")
+
+
 @dataclass(init=True)
 class LabeledNode:
     prediction: str
@@ -109,14 +134,24 @@ class LabeledNode:
 
 
 class SearchGraph:
-    __graph: pgv.AGraph
+    __graph: Optional[pgv.AGraph]
+    __trace: Optional[IO[str]]
     __next_node_id: int
     feature_extractor: Optional[FeaturesExtractor]
     start_node: LabeledNode
 
     def __init__(self, tactics_file: Path, tokens_file: Path, lemma_name: str,
-                 features_json: bool) -> None:
-        self.__graph = pgv.AGraph(directed=True)
+                 features_json: bool, trace_file: Optional[Path] = None) -> None:
+        # When given a trace file, nodes are streamed to it as json lines
+        # instead of being built into a graphviz graph, and can be rendered
+        # later with render_search_graphs.py
+        if trace_file:
+            trace_file.parent.mkdir(parents=True, exist_ok=True)
+            self.__graph = None
+            self.__trace = trace_file.open('w')
+        else:
+            self.__graph = pgv.AGraph(directed=True)
+            self.__trace = None
         self.__next_node_id = 0
         self.start_node = self.mkNode(Prediction(lemma_name, 1.0),
                                       FullContext(
@@ -138,19 +173,25 @@ class SearchGraph:
         tooltip += "-" * 64 + "&#10;"
         tooltip += context_before.obligations.focused_goal[:64]
 
-        self.__graph.add_node(self.__next_node_id,
-                              label="{}\n({:.2f})".format(
-                                  prediction.prediction,
-                                  prediction.certainty),
-                              tooltip=tooltip,
-                              **kwargs)
+        label = "{}\n({:.2f})".format(prediction.prediction,
+                                      prediction.certainty)
+        if self.__graph is not None:
+            self.__graph.add_node(self.__next_node_id,
+                                  label=label,
+                                  tooltip=tooltip,
+                                  **kwargs)
+        else:
+            write_trace_node(unwrap(self.__trace), self.__next_node_id,
+                             previous_node.node_id if previous_node else None,
+                             label, tooltip, kwargs)
         self.__next_node_id += 1
         newNode = LabeledNode(prediction.prediction, prediction.certainty,
                               None, self.__next_node_id-1,
                               context_before, previous_node, [])
         if previous_node:
-            self.__graph.add_edge(previous_node.node_id,
-                                  newNode.node_id, **kwargs)
+            if self.__graph is not None:
+                self.__graph.add_edge(previous_node.node_id,
+                                      newNode.node_id, **kwargs)
             previous_node.children.append(newNode)
         return newNode
 
@@ -171,6 +212,9 @@ class SearchGraph:
         pass
 
     def setNodeColor(self, node: LabeledNode, color: str) -> None:
+        if self.__graph is None:
+            write_trace_color(unwrap(self.__trace), node.node_id, color)
+            return
         node_handle = self.__graph.get_node(node.node_id)
         if node_handle.attr["fillcolor"] != None and node_handle.attr["fillcolor"] != "":
             node_handle.attr["fillcolor"] += (":" + color)
@@ -179,10 +223,19 @@ class SearchGraph:
             node_handle.attr["style"] = "filled"
 
     def draw(self, filename: str) -> None:
+        if self.__graph is None:
+            # The trace has already been streamed out, so just make sure it
+            # makes it to disk.
+            unwrap(self.__trace).flush()
+            return
         Path(filename).parent.mkdir(parents=True, exist_ok=True)
         with nostderr():
             self.__graph.draw(filename, prog="dot")
 
+    def close(self) -> None:
+        if self.__trace:
+            self.__trace.close()
+
     def write_feat_json(self, filename: str) -> None:
         assert self.feature_extractor
         def write_node(node: LabeledNode, f: IO[str]) -> None:
@@ -223,6 +276,10 @@ class SearchGraph:
 class SubSearchResult (NamedTuple):
     solution: Optional[List[TacticInteraction]]
     solved_subgoals: int
+    # Whether anything below was cut off for a reason that depends on the
+    # path taken to get there, so a failure can't be reused for the same
+    # state reached some other way.
+    path_pruned: bool
 
 
 def contextInPath(full_context: ProofContext, path: List[LabeledNode]):
@@ -231,6 +288,210 @@ def contextInPath(full_context: ProofContext, path: List[LabeledNode]):
                 for n in path])
 
 
+def context_fingerprint(context: ProofContext) -> str:
+    def normalize(term: str) -> str:
+        return " ".join(term.split())
+    hasher = hashlib.sha1()
+    for goal_list in [context.fg_goals, context.bg_goals,
+                      context.shelved_goals, context.given_up_goals]:
+        for obligation in goal_list:
+            for hyp in obligation.hypotheses:
+                hasher.update(normalize(hyp).encode())
+                hasher.update(b"\x00")
+            hasher.update(b"\x01")
+            hasher.update(normalize(obligation.goal).encode())
+            hasher.update(b"\x02")
+        hasher.update(b"\x03")
+    return hasher.hexdigest()
+
+
+class TranspositionEntry(NamedTuple):
+    # The shallowest depth this state was reached at, not counting depth
+    # gained back by closing subgoals.
+    depth: int
+    # The length of the path it was reached by, which the hard depth limit
+    # applies to.
+    path_length: int
+    status: SearchStatus
+
+
+TranspositionKey = Tuple[str, Tuple[int, ...]]
+
+
+class TranspositionTable:
+    # Maps proof states reached during the search for a single lemma to the
+    # best depth they were reached at and what came of searching them, so
+    # that the same state reached through a different tactic order isn't
+    # searched again. States are keyed along with the subgoal distance
+    # stack, since that decides how much depth closing subgoals below them
+    # gives back.
+    __entries: Dict[TranspositionKey, TranspositionEntry]
+
+    def __init__(self) -> None:
+        self.__entries = {}
+
+    def lookup(self, context: ProofContext,
+               distance_stack: Sequence[int] = ()) \
+            -> Optional[TranspositionEntry]:
+        return self.__entries.get((context_fingerprint(context),
+                                   tuple(distance_stack)))
+
+    def record(self, context: ProofContext, depth: int,
+               status: SearchStatus, path_length: int = 0,
+               distance_stack: Sequence[int] = ()) -> None:
+        key = (context_fingerprint(context), tuple(distance_stack))
+        old_entry = self.__entries.get(key)
+        if old_entry is not None and old_entry.depth < depth and \
+                old_entry.path_length <= path_length:
+            return
+        self.__entries[key] = TranspositionEntry(depth, path_length, status)
+
+    def seen_at_depth(self, context: ProofContext, depth: int) -> bool:
+        entry = self.lookup(context)
+        return entry is not None and entry.depth <= depth
+
+    def failed_at_depth(self, context: ProofContext, depth: int,
+                        path_length: int,
+                        distance_stack: Sequence[int]) -> bool:
+        # Only failures searched with at least as much depth left, under
+        # both the search depth and the hard depth limit, carry over.
+        entry = self.lookup(context, distance_stack)
+        return entry is not None and \
+            entry.status == SearchStatus.FAILURE and \
+            entry.depth <= depth and \
+            entry.path_length <= path_length
+
+
+class CachedTacticFailure(Exception):
+    pass
+
+
+class CachedTimeoutError(CachedTacticFailure):
+    # A cached failure that was a timeout, which callers may need to tell
+    # apart, since it depends on how much time the tactic was given.
+    pass
+
+
+# The environment a proof is in and the fingerprint of a state in it
+FailedTacticKey = Tuple[str, str]
+# The name of the error a tactic failed with, and the timeout it was run with
+FailedTacticValue = Tuple[str, float]
+FailedTactics = Dict[str, FailedTacticValue]
+
+
+class FailedTacticCache:
+    # Tactics known to fail in a given proof state, grouped by the
+    # environment the proof is in and the fingerprint of the state, and
+    # keyed by the tactic string. Whether a tactic works depends on what's
+    # been defined before the proof too, so the environment is a hash of
+    # the file up to the lemma being searched, set at the start of each job.
+    #
+    # The backing mapping can be a multiprocessing manager dict, so that all
+    # the workers of a run share one cache. Each state's failures are
+    # fetched from it once and then kept in a local cache for the rest of
+    # the lemma, so looking up every prediction at a node costs at most one
+    # round trip. Two workers recording failures at the same state at once
+    # can overwrite each other's, which only loses cache entries.
+    failures: MutableMapping[FailedTacticKey, FailedTactics]
+    # The failures recorded by this process, so they can be saved separately
+    recorded: Dict[FailedTacticKey, FailedTactics]
+    environment: str
+    local: Dict[FailedTacticKey, FailedTactics]
+
+    def __init__(self, failures: MutableMapping[FailedTacticKey,
+                                                FailedTactics]) -> None:
+        self.failures = failures
+        self.recorded = {}
+        self.environment = ""
+        self.local = {}
+
+    def set_environment(self, environment: Sequence[str]) -> None:
+        hasher = hashlib.sha1()
+        for part in environment:
+            hasher.update(part.encode())
+            hasher.update(b"\x00")
+        self.environment = hasher.hexdigest()
+        self.local = {}
+
+    def _failures_at(self, context: ProofContext) \
+            -> Tuple[FailedTacticKey, FailedTactics]:
+        key = (self.environment, context_fingerprint(context))
+        tactics = self.local.get(key)
+        if tactics is None:
+            tactics = dict(self.failures.get(key, {}))
+            self.local[key] = tactics
+        return key, tactics
+
+    def lookup(self, context: ProofContext, tactic: str,
+               timeout: float) -> Optional[str]:
+        _, tactics = self._failures_at(context)
+        failure = tactics.get(tactic)
+        if failure is None:
+            return None
+        error_name, failed_timeout = failure
+        # A tactic that timed out might still succeed with more time
+        if error_name == "TimeoutError" and timeout > failed_timeout:
+            return None
+        return error_name
+
+    def record(self, context: ProofContext, tactic: str,
+               error: Exception, timeout: float) -> None:
+        key, tactics = self._failures_at(context)
+        tactics[tactic] = (type(error).__name__, timeout)
+        self.failures[key] = tactics
+        self.recorded.setdefault(key, {})[tactic] = tactics[tactic]
+
+
+def failed_tactic_shards(path: Path) -> List[Path]:
+    # Cluster workers each save the failures they found next to the cache
+    # file, to be merged into it at the end of the run.
+    return sorted(path.parent.glob(glob.escape(path.name) + ".shard-*"))
+
+
+def load_failed_tactics(path: Path) -> Dict[FailedTacticKey, FailedTactics]:
+    failures: Dict[FailedTacticKey, FailedTactics] = {}
+    for cache_file in [path] + failed_tactic_shards(path):
+        try:
+            with cache_file.open('r') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    # Entries from before the environment was part of the
+                    # key can't be trusted for any particular file
+                    if len(entry) != 5:
+                        continue
+                    environment, fingerprint, tactic, error_name, timeout = \
+                        entry
+                    failures.setdefault((environment, fingerprint), {})[
+                        tactic] = (error_name, timeout)
+        except FileNotFoundError:
+            pass
+    return failures
+
+
+def save_failed_tactics(path: Path,
+                        failures: Mapping[FailedTacticKey,
+                                          FailedTactics]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w') as f:
+        for (environment, fingerprint), tactics in failures.items():
+            for tactic, (error_name, timeout) in tactics.items():
+                print(json.dumps((environment, fingerprint, tactic,
+                                  error_name, timeout)),
+                      file=f)
+
+
+def merge_failed_tactic_shards(path: Path) -> None:
+    shards = failed_tactic_shards(path)
+    if not shards:
+        return
+    save_failed_tactics(path, load_failed_tactics(path))
+    for shard in shards:
+        os.remove(shard)
+
+
+failed_tactic_cache: Optional[FailedTacticCache] = None
+
+
 def numNodesInTree(branching_factor: int, depth: int):
     assert depth > 0, f"depth is {depth}"
     result = int((branching_factor ** depth - 1) /
@@ -257,12 +518,26 @@ def tryPrediction(args: argparse.Namespace,
     start_time = time.time()
     time_per_command = (coq.hammer_timeout + args.max_tactic_time
                         if coq.use_hammer else args.max_tactic_time)
+    timeout = min(time_left, time_per_command)
+    context_before = unwrap(coq.proof_context)
+    if failed_tactic_cache:
+        cached_error = failed_tactic_cache.lookup(context_before, prediction,
+                                                  timeout)
+        if cached_error:
+            error_type = CachedTimeoutError \
+                if cached_error == "TimeoutError" else CachedTacticFailure
+            return (context_before, 0, 0, 0, error_type(cached_error),
+                    0., False)
     try:
-        coq.run_stmt(prediction, timeout=min(time_left, time_per_command))
+        coq.run_stmt(prediction, timeout=timeout)
         error = None
     except (coq_serapy.TimeoutError, coq_serapy.ParseError,
-            coq_serapy.CoqExn, coq_serapy.OverflowError,
-            coq_serapy.ParseError,
+            coq_serapy.CoqExn) as e:
+        if failed_tactic_cache:
+            failed_tactic_cache.record(context_before, prediction, e, timeout)
+        return (unwrap(coq.proof_context), 0, 0, 0, e,
+                time.time() - start_time, False)
+    except (coq_serapy.OverflowError,
             RecursionError,
             coq_serapy.UnrecognizedError) as e:
         return (unwrap(coq.proof_context), 0, 0, 0, e,
@@ -337,8 +612,10 @@ def dfs_proof_search_with_graph(lemma_name: str,
                                 bar_idx: int,
                                 predictor: TacticPredictor) \
                                 -> SearchResult:
+    graph_path = search_graph_path(output_dir, module_prefix, lemma_name, args)
     g = SearchGraph(args.tactics_file, args.tokens_file, lemma_name,
-                    args.features_json)
+                    args.features_json,
+                    graph_path if args.graph_format == "trace" else None)
 
     def cleanupSearch(num_stmts: int, msg: Optional[str] = None):
         if msg:
@@ -347,6 +624,7 @@ def dfs_proof_search_with_graph(lemma_name: str,
         for _ in range(num_stmts):
             coq.cancel_last()
     hasUnexploredNode = False
+    transpositions = TranspositionTable()
 
     def search(pbar: tqdm, current_path: List[LabeledNode],
                subgoal_distance_stack: List[int],
@@ -354,6 +632,7 @@ def dfs_proof_search_with_graph(lemma_name: str,
         nonlocal hasUnexploredNode
         nonlocal relevant_lemmas
         global unnamed_goal_number
+        path_pruned = False
         full_context_before = FullContext(relevant_lemmas,
                                           coq.prev_tactics,
                                           unwrap(coq.proof_context))
@@ -377,6 +656,11 @@ def dfs_proof_search_with_graph(lemma_name: str,
                     tryPrediction(args, coq, prediction.prediction,
                                   time_on_path(current_path[-1]))
                 if error:
+                    if isinstance(error, (coq_serapy.TimeoutError,
+                                          CachedTimeoutError)):
+                        # The timeout may have come from the time left for
+                        # the whole proof, which depends on the path taken
+                        path_pruned = True
                     if args.count_failing_predictions:
                         num_successful_predictions += 1
                     if args.show_failing_predictions:
@@ -422,9 +706,11 @@ def dfs_proof_search_with_graph(lemma_name: str,
                 #############
                 if completed_proof(coq):
                     solution = g.mkQED(predictionNode)
-                    return SubSearchResult(solution, subgoals_closed)
+                    return SubSearchResult(solution, subgoals_closed,
+                                           path_pruned)
                 elif contextInPath(context_after,
                                    current_path[1:] + [predictionNode]):
+                    path_pruned = True
                     if not args.count_softfail_predictions:
                         num_successful_predictions -= 1
                     g.setNodeColor(predictionNode, "orange")
@@ -434,6 +720,16 @@ def dfs_proof_search_with_graph(lemma_name: str,
                     g.setNodeColor(predictionNode, "orange4")
                     cleanupSearch(num_stmts,
                                   "resulting context has too big a goal")
+                elif args.transposition_table and \
+                        transpositions.failed_at_depth(
+                            context_after,
+                            len(current_path) - new_extra_depth,
+                            len(current_path), new_distance_stack):
+                    if not args.count_softfail_predictions:
+                        num_successful_predictions -= 1
+                    g.setNodeColor(predictionNode, "purple")
+                    cleanupSearch(num_stmts,
+                                  "resulting context was already searched")
                 elif len(current_path) < args.search_depth + new_extra_depth \
                         and len(current_path) < args.hard_depth_limit:
                     if subgoals_closed > 0:
@@ -443,6 +739,16 @@ def dfs_proof_search_with_graph(lemma_name: str,
                                                new_distance_stack,
                                                new_extra_depth)
                     cleanupSearch(num_stmts, "we finished subsearch")
+                    if args.transposition_table and \
+                       not sub_search_result.solution and \
+                       sub_search_result.solved_subgoals == 0 and \
+                       not sub_search_result.path_pruned:
+                        transpositions.record(
+                            context_after,
+                            len(current_path) - new_extra_depth,
+                            SearchStatus.FAILURE,
+                            len(current_path), new_distance_stack)
+                    path_pruned = path_pruned or sub_search_result.path_pruned
                     if sub_search_result.solution or \
                        sub_search_result.solved_subgoals > subgoals_opened:
                         new_subgoals_closed = \
@@ -450,16 +756,19 @@ def dfs_proof_search_with_graph(lemma_name: str,
                             sub_search_result.solved_subgoals - \
                             subgoals_opened
                         return SubSearchResult(sub_search_result.solution,
-                                               new_subgoals_closed)
+                                               new_subgoals_closed,
+                                               path_pruned)
                     if subgoals_closed > 0:
-                        return SubSearchResult(None, subgoals_closed)
+                        return SubSearchResult(None, subgoals_closed,
+                                               path_pruned)
                 else:
                     hasUnexploredNode = True
                     cleanupSearch(num_stmts, "we hit the depth limit")
                     if subgoals_closed > 0:
                         # depth = (args.search_depth + new_extra_depth + 1) \
                         #     - len(current_path)
-                        return SubSearchResult(None, subgoals_closed)
+                        return SubSearchResult(None, subgoals_closed,
+                                               path_pruned)
             except coq_serapy.CoqAnomaly:
                 predictionNode = g.mkNode(prediction,
                                           full_context_before,
@@ -473,11 +782,10 @@ def dfs_proof_search_with_graph(lemma_name: str,
                     if args.features_json:
                         g.write_feat_json(f"{output_dir}/{module_prefix}"
                                           f"{lemma_name}.json")
-                    g.draw(f"{output_dir}/{module_prefix}"
-                           f"{lemma_name}.svg")
+                    g.draw(str(graph_path))
 
                 raise
-        return SubSearchResult(None, 0)
+        return SubSearchResult(None, 0, path_pruned)
     total_nodes = numNodesInTree(args.search_width,
                                  args.search_depth + 2) - 1
     desc_name = lemma_name
@@ -489,27 +797,32 @@ def dfs_proof_search_with_graph(lemma_name: str,
     else:
         subgoals_stack_start = []
 
-    with TqdmSpy(total=total_nodes, unit="pred", file=sys.stdout,
-                 desc=desc_name, disable=(not args.progress),
-                 leave=False,
-                 position=bar_idx + 1,
-                 dynamic_ncols=True, bar_format=mybarfmt) as pbar:
-        if args.search_prefix is None:
-            command_list, _ = search(pbar, [g.start_node], subgoals_stack_start, 0)
-        else:
-            next_node = g.start_node
-            for command in coq_serapy.read_commands(args.search_prefix):
-                full_context_before = FullContext(relevant_lemmas,
-                                                  coq.prev_tactics,
-                                                  unwrap(coq.proof_context))
-                next_node = g.mkNode(Prediction(command, 1.0),
-                                     full_context_before,
-                                     next_node)
-                next_node.time_taken = 0.0
-                coq.run_stmt(command)
-            command_list, _ = search(pbar, [next_node], subgoals_stack_start, 0)
-        pbar.clear()
-    g.draw(f"{output_dir}/{module_prefix}{lemma_name}.svg")
+    # The anomaly path re-raises out of the search, so close the trace file
+    # whichever way it ends.
+    try:
+        with TqdmSpy(total=total_nodes, unit="pred", file=sys.stdout,
+                     desc=desc_name, disable=(not args.progress),
+                     leave=False,
+                     position=bar_idx + 1,
+                     dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+            if args.search_prefix is None:
+                command_list, _, _ = search(pbar, [g.start_node], subgoals_stack_start, 0)
+            else:
+                next_node = g.start_node
+                for command in coq_serapy.read_commands(args.search_prefix):
+                    full_context_before = FullContext(relevant_lemmas,
+                                                      coq.prev_tactics,
+                                                      unwrap(coq.proof_context))
+                    next_node = g.mkNode(Prediction(command, 1.0),
+                                         full_context_before,
+                                         next_node)
+                    next_node.time_taken = 0.0
+                    coq.run_stmt(command)
+                command_list, _, _ = search(pbar, [next_node], subgoals_stack_start, 0)
+            pbar.clear()
+        g.draw(str(graph_path))
+    finally:
+        g.close()
     if args.features_json:
         g.write_feat_json(f"{output_dir}/{module_prefix}"
                           f"{lemma_name}.json")
@@ -534,6 +847,10 @@ class BFSNode:
     score: float
     time_taken: float
     context_before: FullContext
+    # The context this node's tactic leads to, kept by beam search while the
+    # node is on the frontier when it batches predictions or uses the
+    # transposition table, and dropped once the node is expanded or cut.
+    context_after: Optional[FullContext]
     previous: Optional["BFSNode"]
     children: List["BFSNode"]
     color: Optional[str]
@@ -546,6 +863,7 @@ class BFSNode:
         self.time_taken = time_taken
         self.postfix = postfix
         self.context_before = context_before
+        self.context_after = None
         self.previous = previous
         self.children = []
         if self.previous:
@@ -604,6 +922,33 @@ class BFSNode:
         with nostderr():
             graph.draw(path, prog="dot")
 
+    def write_trace(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        next_node_id = 0
+        with path.open('w') as trace:
+            nodes_todo: List[Tuple["BFSNode", Optional[int]]] = [(self, None)]
+            while nodes_todo:
+                node, parent_id = nodes_todo.pop()
+                tooltip = ""
+                for hyp in node.context_before.obligations.focused_hyps:
+                    tooltip += hyp[:64] + "&#10;"
+                tooltip += "-" * 64 + "&#10;"
+                tooltip += node.context_before.obligations.focused_goal[:64]
+                write_trace_node(trace, next_node_id, parent_id,
+                                 f"{node.prediction.prediction}\n{node.score:.2e}",
+                                 tooltip, {})
+                if node.color:
+                    write_trace_color(trace, next_node_id, node.color)
+                nodes_todo += [(child, next_node_id)
+                               for child in reversed(node.children)]
+                next_node_id += 1
+
+    def save_graph(self, path: Path, args: argparse.Namespace) -> None:
+        if args.graph_format == "trace":
+            self.write_trace(path)
+        else:
+            self.draw_graph(str(path))
+
     def pp(self) -> str:
         if not self.previous:
             return f" -> {self.prediction.prediction}"
@@ -682,7 +1027,8 @@ def bfs_beam_proof_search(lemma_name: str,
                           predictor: TacticPredictor) \
                           -> SearchResult:
     hasUnexploredNode = False
-    graph_file = f"{args.output_dir}/{module_prefix}{lemma_name}.svg"
+    graph_file = search_graph_path(args.output_dir, module_prefix,
+                                   lemma_name, args)
 
     features_extractor = FeaturesExtractor(args.tactics_file, args.tokens_file)
     if args.scoring_function == "lstd":
@@ -710,6 +1056,7 @@ def bfs_beam_proof_search(lemma_name: str,
         subgoals_stack_start = []
     nodes_todo: List[Tuple[BFSNode, List[int], int]] = \
         [(search_start_node, subgoals_stack_start, 0)]
+    transpositions = TranspositionTable()
 
     total_nodes = numNodesInTree(args.search_width,
                                  args.search_depth + 2) - 1
@@ -720,19 +1067,50 @@ def bfs_beam_proof_search(lemma_name: str,
               dynamic_ncols=True, bar_format=mybarfmt) as pbar:
         while len(nodes_todo) > 0:
             next_nodes_todo: List[Tuple[BFSNode, List[int], int]] = []
+            if args.batch_beam_predictions:
+                # Each level is predicted on together, from the contexts
+                # kept on the nodes, without visiting each node.
+                for node, _, _ in nodes_todo:
+                    if node.context_after is None:
+                        node.traverse_to(coq, initial_history_len)
+                        node.context_after = FullContext(
+                            relevant_lemmas, coq.prev_tactics,
+                            unwrap(coq.proof_context))
+                level_predictions = dict(zip(
+                    [id(node) for node, _, _ in nodes_todo],
+                    predictor.predictKTactics_batch(
+                        [truncate_tactic_context(
+                            unwrap(node.context_after).as_tcontext(),
+                            args.max_term_length)
+                         for node, _, _ in nodes_todo],
+                        args.max_attempts)))
             while len(nodes_todo) > 0:
                 next_node, subgoal_distance_stack, extra_depth = nodes_todo.pop()
+                next_node.context_after = None
                 pbar.update()
                 next_node.traverse_to(coq, initial_history_len)
 
                 full_context_before = FullContext(relevant_lemmas,
                                                   coq.prev_tactics,
                                                   unwrap(coq.proof_context))
+                if args.transposition_table:
+                    node_depth = len(next_node.path()) - extra_depth
+                    if transpositions.seen_at_depth(
+                            full_context_before.obligations, node_depth):
+                        eprint(f"Node already expanded at a shallower depth",
+                               guard=args.verbose >= 2)
+                        next_node.setNodeColor("purple")
+                        continue
+                    transpositions.record(full_context_before.obligations,
+                                          node_depth, SearchStatus.INCOMPLETE)
                 num_successful_predictions = 0
-                predictions = predictor.predictKTactics(
-                    truncate_tactic_context(full_context_before.as_tcontext(),
-                                            args.max_term_length),
-                            args.max_attempts)
+                if args.batch_beam_predictions:
+                    predictions = level_predictions[id(next_node)]
+                else:
+                    predictions = predictor.predictKTactics(
+                        truncate_tactic_context(full_context_before.as_tcontext(),
+                                                args.max_term_length),
+                                args.max_attempts)
                 for prediction in predictions:
                     if num_successful_predictions >= args.search_width:
                         break
@@ -776,10 +1154,38 @@ def bfs_beam_proof_search(lemma_name: str,
                         continue
                     if completed_proof(coq):
                         prediction_node.mkQED()
-                        start_node.draw_graph(graph_file)
+                        start_node.save_graph(graph_file, args)
                         return SearchResult(SearchStatus.SUCCESS,
                                             prediction_node.interactions()[1:])
 
+                    # ### 1.
+                    if subgoal_distance_stack:
+                        new_distance_stack = (subgoal_distance_stack[:-1] +
+                                              [subgoal_distance_stack[-1]+1])
+                    else:
+                        new_distance_stack = []
+
+                    # ### 2.
+                    new_extra_depth = extra_depth
+                    for _ in range(subgoals_closed):
+                        closed_goal_distance = new_distance_stack.pop()
+                        new_extra_depth += closed_goal_distance
+
+                    # ### 3.
+                    new_distance_stack += [0] * subgoals_opened
+
+                    if args.transposition_table:
+                        node_depth = len(prediction_node.path()) - new_extra_depth
+                        if transpositions.seen_at_depth(context_after, node_depth):
+                            if args.count_softfail_predictions:
+                                num_successful_predictions += 1
+                            eprint(f"Prediction already expanded at a shallower depth",
+                                   guard=args.verbose >= 2)
+                            prediction_node.setNodeColor("purple")
+                            for _ in range(num_stmts):
+                                coq.cancel_last()
+                            continue
+
                     if args.scoring_function == "certainty":
                         prediction_node.score = next_node.score * prediction.certainty
                     elif args.scoring_function == "pickled":
@@ -815,40 +1221,43 @@ def bfs_beam_proof_search(lemma_name: str,
                         nodes_todo = [node for node in nodes_todo if node[0] not in prunable_nodes]
                         # Prune them from next_nodes_todo, which are new children
                         # of nodes at the current level which we already explored.
+                        for node in prunable_nodes:
+                            node.context_after = None
                         next_nodes_todo = [node for node in next_nodes_todo if node[0] not in prunable_nodes]
 
-                    # ### 1.
-                    if subgoal_distance_stack:
-                        new_distance_stack = (subgoal_distance_stack[:-1] +
-                                              [subgoal_distance_stack[-1]+1])
-                    else:
-                        new_distance_stack = []
-
-                    # ### 2.
-                    new_extra_depth = extra_depth
-                    for _ in range(subgoals_closed):
-                        closed_goal_distance = new_distance_stack.pop()
-                        new_extra_depth += closed_goal_distance
-
-                    # ### 3.
-                    new_distance_stack += [0] * subgoals_opened
-
                     next_nodes_todo.append((prediction_node, new_distance_stack,
                                             new_extra_depth))
+                    if args.batch_beam_predictions or args.transposition_table:
+                        prediction_node.context_after = FullContext(
+                            relevant_lemmas, coq.prev_tactics,
+                            unwrap(coq.proof_context))
 
                     for _ in range(num_stmts):
                         coq.cancel_last()
                     if subgoals_closed > 0:
                         break
             next_nodes_todo.sort(key=lambda n: n[0].score, reverse=True)
+            beam_states: Set[str] = set()
             while len(nodes_todo) < args.beam_width and len(next_nodes_todo) > 0:
                 next_node, subgoal_distance_stack, extra_depth = next_nodes_todo.pop(0)
+                if args.transposition_table:
+                    state = context_fingerprint(
+                        unwrap(next_node.context_after).obligations)
+                    if state in beam_states:
+                        next_node.setNodeColor("purple")
+                        next_node.context_after = None
+                        continue
+                    beam_states.add(state)
                 if len(next_node.path()) <= args.search_depth + extra_depth:
                     nodes_todo.append((next_node, subgoal_distance_stack, extra_depth))
                 else:
+                    next_node.context_after = None
                     hasUnexploredNode = True
+            # The nodes that didn't make the beam won't be expanded
+            for node, _, _ in next_nodes_todo:
+                node.context_after = None
 
-    start_node.draw_graph(graph_file)
+    start_node.save_graph(graph_file, args)
     if hasUnexploredNode:
         return SearchResult(SearchStatus.INCOMPLETE, None)
     else:
@@ -872,7 +1281,8 @@ def best_first_proof_search(lemma_name: str,
     if args.scoring_function == "pickled":
         with args.pickled_estimator.open('rb') as f:
             john_model = pickle.load(f)
-    graph_file = f"{args.output_dir}/{module_prefix}{lemma_name}.svg"
+    graph_file = search_graph_path(args.output_dir, module_prefix,
+                                   lemma_name, args)
     initial_history_len = len(coq.tactic_history.getFullHistory())
     start_node = BFSNode(Prediction(lemma_name, 1.0), 1.0, 0.0, [],
                          FullContext([], [],
@@ -886,6 +1296,10 @@ def best_first_proof_search(lemma_name: str,
             search_start_node = BFSNode(Prediction(command, 1.0), 1.0, 0.0, [],
                                         full_context_before, search_start_node)
     nodes_todo: List[AStarTask] = [AStarTask(1.0, search_start_node)]
+    transpositions = TranspositionTable()
+    # The frontier task reaching each state, so that a state reached again
+    # keeps only its best-scored task.
+    live_states: Dict[str, AStarTask] = {}
 
     desc_name = lemma_name
     if len(desc_name) > 25:
@@ -902,6 +1316,12 @@ def best_first_proof_search(lemma_name: str,
         full_context_before = FullContext(relevant_lemmas,
                                           coq.prev_tactics,
                                           unwrap(coq.proof_context))
+        if args.transposition_table:
+            live_states.pop(context_fingerprint(full_context_before.obligations),
+                            None)
+            transpositions.record(full_context_before.obligations,
+                                  len(next_node.node.path()),
+                                  SearchStatus.INCOMPLETE)
         num_successful_predictions = 0
         predictions = predictor.predictKTactics(
             truncate_tactic_context(full_context_before.as_tcontext(),
@@ -955,9 +1375,21 @@ def best_first_proof_search(lemma_name: str,
             # Check if the proof is done
             if completed_proof(coq):
                 prediction_node.mkQED()
-                start_node.draw_graph(graph_file)
+                start_node.save_graph(graph_file, args)
                 return SearchResult(SearchStatus.SUCCESS,
                                     prediction_node.interactions()[1:])
+            # Check if we've already expanded this state some other way
+            if args.transposition_table and \
+                    transpositions.seen_at_depth(context_after,
+                                                 len(prediction_node.path())):
+                if args.count_softfail_predictions:
+                    num_successful_predictions += 1
+                eprint(f"Prediction already expanded at a shallower depth",
+                       guard=args.verbose >= 2)
+                prediction_node.setNodeColor("purple")
+                for _ in range(num_stmts):
+                    coq.cancel_last()
+                continue
             if args.scoring_function == "const":
                 h_score = 1.
             elif args.scoring_function == "certainty":
@@ -982,8 +1414,29 @@ def best_first_proof_search(lemma_name: str,
 
             prediction_node.score = score
 
+            # Check if this state is already on the frontier, and keep
+            # whichever task for it scores better
+            if args.transposition_table:
+                state = context_fingerprint(context_after)
+                live_task = live_states.get(state)
+                if live_task is not None and live_task.f_score <= score:
+                    eprint(f"Prediction already on the frontier with a better score",
+                           guard=args.verbose >= 2)
+                    prediction_node.setNodeColor("purple")
+                    for _ in range(num_stmts):
+                        coq.cancel_last()
+                    continue
+                if live_task is not None:
+                    live_task.node.setNodeColor("purple")
+                    nodes_todo = [task for task in nodes_todo
+                                  if task is not live_task]
+                    heapq.heapify(nodes_todo)
+            task = AStarTask(score, prediction_node)
+            if args.transposition_table:
+                live_states[state] = task
+
             # Put our new prediction node in our priority queue
-            heapq.heappush(nodes_todo, AStarTask(score, prediction_node))
+            heapq.heappush(nodes_todo, task)
             # Return us to before running the prediction, so we're ready for
             # the next one.
             for _ in range(num_stmts):
@@ -998,11 +1451,14 @@ def best_first_proof_search(lemma_name: str,
                 nodes_todo = [node for node in nodes_todo
                               if node.node not in prunable_nodes]
                 heapq.heapify(nodes_todo)
+                live_states = {state: task for state, task
+                               in live_states.items()
+                               if task.node not in prunable_nodes}
                 # Don't run the rest of the predictions at this state
                 break
 
     hasUnexploredNode = len(nodes_todo) > 0
-    start_node.draw_graph(graph_file)
+    start_node.save_graph(graph_file, args)
     if hasUnexploredNode:
         return SearchResult(SearchStatus.INCOMPLETE, None)
     else:
@@ -4,14 +4,18 @@ import argparse
 import subprocess
 import re
 import os
+import time
 import traceback
-from typing import NamedTuple, Optional, Dict, List, cast, Tuple, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (NamedTuple, Optional, Dict, List, cast, Tuple, Iterable,
+                    Iterator)
 from pathlib import Path
 
 import coq_serapy
 from coq_serapy.contexts import ProofContext
 from models.tactic_predictor import TacticPredictor
 from search_results import SearchResult, KilledException, SearchStatus, TacticInteraction
+import search_strategies
 from search_strategies import best_first_proof_search, bfs_beam_proof_search, dfs_proof_search_with_graph
 
 from util import unwrap, eprint, escape_lemma_name
@@ -24,11 +28,64 @@ class ReportJob(NamedTuple):
     module_prefix: str
     lemma_statement: str
 
+def start_sertop(args: argparse.Namespace,
+                 prelude: str) -> coq_serapy.SerapiInstance:
+    coq = coq_serapy.SerapiInstance(['sertop', '--implicit'],
+                                    None, prelude,
+                                    use_hammer=args.use_hammer)
+    coq.quiet = True
+    coq.verbose = args.verbose
+    return coq
+
+class SertopPool:
+    # Keeps some spare sertop instances starting up in the background, so
+    # that restarting Coq after an anomaly (or for a new project) can swap in
+    # one that's ready instead of waiting for sertop to start and load the
+    # prelude. The opam switch is picked up from the environment when sertop
+    # starts, so spares are only used for the prelude and switch they were
+    # started with.
+    def __init__(self, args: argparse.Namespace, num_spares: int) -> None:
+        self.args = args
+        self.num_spares = num_spares
+        self.executor = ThreadPoolExecutor(max_workers=max(num_spares, 1))
+        self.spares: List[Tuple[Tuple[str, Optional[str]],
+                                'Future[coq_serapy.SerapiInstance]']] = []
+
+    def get(self, prelude: str) -> coq_serapy.SerapiInstance:
+        key = (prelude, os.environ.get("OPAM_SWITCH_PREFIX"))
+        matching_spares = [spare for spare_key, spare in self.spares
+                           if spare_key == key]
+        for spare_key, spare in self.spares:
+            if spare_key != key:
+                spare.add_done_callback(lambda f: f.result().kill())
+        self.spares = [(key, spare) for spare in matching_spares]
+        coq: Optional[coq_serapy.SerapiInstance] = None
+        while self.spares and coq is None:
+            _, spare = self.spares.pop(0)
+            try:
+                coq = spare.result()
+            except Exception:
+                eprint("Failed to start a spare sertop",
+                       guard=self.args.verbose >= 1)
+        if coq is None:
+            coq = start_sertop(self.args, prelude)
+        while len(self.spares) < self.num_spares:
+            self.spares.append((key, self.executor.submit(
+                start_sertop, self.args, prelude)))
+        return coq
+
+    def close(self) -> None:
+        for _, spare in self.spares:
+            spare.add_done_callback(lambda f: f.result().kill())
+        self.spares = []
+        self.executor.shutdown(wait=True)
+
 class Worker:
     args: argparse.Namespace
     widx: int
     predictor: TacticPredictor
     coq: Optional[coq_serapy.SerapiInstance]
+    sertop_pool: SertopPool
     switch_dict: Optional[Dict[str, str]]
 
     # File-local state
@@ -37,6 +94,7 @@ class Worker:
     last_program_statement: Optional[str]
     lemmas_encountered: List[ReportJob]
     remaining_commands: List[str]
+    file_commands: List[str]
     axioms_already_added: bool
 
     def __init__(self, args: argparse.Namespace, worker_idx: int,
@@ -46,25 +104,24 @@ class Worker:
         self.widx = worker_idx
         self.predictor = predictor
         self.coq = None
+        self.sertop_pool = SertopPool(args, args.warm_sertops)
         self.cur_file: Optional[str] = None
         self.cur_project: Optional[str] = None
         self.last_program_statement: Optional[str] = None
         self.lemmas_encountered: List[ReportJob] = []
         self.remaining_commands: List[str] = []
+        self.file_commands: List[str] = []
         self.switch_dict = switch_dict
         self.axioms_already_added = False
 
     def __enter__(self) -> 'Worker':
-        self.coq = coq_serapy.SerapiInstance(['sertop', '--implicit'],
-                                    None, str(self.args.prelude),
-                                    use_hammer=self.args.use_hammer)
-        self.coq.quiet = True
-        self.coq.verbose = self.args.verbose
+        self.coq = self.sertop_pool.get(str(self.args.prelude))
         return self
     def __exit__(self, type, value, traceback) -> None:
         assert self.coq
         self.coq.kill()
         self.coq = None
+        self.sertop_pool.close()
 
     def set_switch_from_proj(self) -> None:
         assert self.cur_project
@@ -82,11 +139,8 @@ class Worker:
     def restart_coq(self) -> None:
         assert self.coq
         self.coq.kill()
-        self.coq = coq_serapy.SerapiInstance(['sertop', '--implicit'],
-                                    None, str(self.args.prelude / self.cur_project),
-                                    use_hammer=self.args.use_hammer)
-        self.coq.quiet = True
-        self.coq.verbose = self.args.verbose
+        self.coq = self.sertop_pool.get(
+            str(self.args.prelude / self.cur_project))
 
     def reset_file_state(self) -> None:
         self.last_program_statement = None
@@ -101,16 +155,44 @@ class Worker:
         self.coq.run_stmt(f"Module {module_name}.")
         self.remaining_commands = coq_serapy.load_commands_preserve(
             self.args, 1, self.args.prelude / self.cur_project / filename)
+        self.file_commands = list(self.remaining_commands)
         self.axioms_already_added = False
 
+    def restart_file(self, filename: str) -> None:
+        # After an anomaly Coq can't be trusted, so start a fresh one and go
+        # through the file from the top again.
+        self.restart_coq()
+        self.reset_file_state()
+        self.enter_file(filename)
+
+    def environment_before_lemma(self) -> List[str]:
+        # What decides whether a tactic can work in the current lemma,
+        # besides its proof state: the project it's built in, the file's
+        # commands before the lemma statement, and any axioms added before
+        # it. Lemmas in different files with the same prefix share an
+        # environment.
+        num_commands_run = len(self.file_commands) - \
+            len(self.remaining_commands)
+        environment = [unwrap(self.cur_project)] + \
+            self.file_commands[:num_commands_run - 1]
+        if self.args.add_axioms:
+            environment.append(str(self.args.add_axioms))
+        return environment
+
     def exit_cur_file(self) -> None:
         for sec_or_mod, _ in reversed(self.coq.sm_stack):
             self.coq.run_stmt(f"Reset {sec_or_mod}.")
 
     def run_into_job(self, job: ReportJob, restart_anomaly: bool, careful: bool) -> None:
         assert self.coq
-        assert job not in self.lemmas_encountered, "Jobs are out of order!"
         job_project, job_file, job_module, job_lemma = job
+        # If we've already gone past this job in the current file (because
+        # we were handed a later chunk of the file first), start the file
+        # over.
+        if job in self.lemmas_encountered:
+            self.reset_file_state()
+            self.exit_cur_file()
+            self.enter_file(job_file)
         # If we need to change projects, we'll have to reset the coq instance
         # to load new includes, and set the opam switch
         if job_project != self.cur_project:
@@ -137,10 +219,8 @@ class Worker:
                                       self.remaining_commands)))
                     assert rest_commands, f"Couldn't find lemma {job_lemma}"
             except coq_serapy.CoqAnomaly:
-                if restart:
-                    self.restart_coq()
-                    self.reset_file_state()
-                    self.enter_file(job_file)
+                if restart_anomaly:
+                    self.restart_file(job_file)
                     eprint(f"Hit a coq anomaly! Restarting...",
                            guard=self.args.verbose >= 1)
                     self.run_into_job(job, False, careful)
@@ -244,14 +324,20 @@ class Worker:
                         eprint(f"Couldn't declare axiom {axiom_name} "
                                f"at this point in the proof")
             self.coq.run_stmt(job_lemma)
+        if search_strategies.failed_tactic_cache:
+            search_strategies.failed_tactic_cache.set_environment(
+                self.environment_before_lemma())
         empty_context = ProofContext([], [], [], [])
+        search_start_time = time.time()
         try:
-            search_status, tactic_solution = \
+            search_result = \
               attempt_search(self.args, job_lemma,
                              self.coq.sm_prefix,
                              self.coq,
                              self.args.output_dir / self.cur_project,
                              self.widx, self.predictor)
+            search_status = search_result.status
+            tactic_solution = search_result.commands
         except KilledException:
             tactic_solution = None
             search_status = SearchStatus.INCOMPLETE
@@ -263,9 +349,7 @@ class Worker:
                     print(f"ANOMALY at {job_file}:{job_lemma}",
                           file=f)
                     traceback.print_exc(file=f)
-            self.restart_coq()
-            self.reset_file_state()
-            self.enter_file(job_file)
+            self.restart_file(job_file)
             if restart:
                 eprint("Hit an anomaly, restarting job", guard=self.args.verbose >= 2)
                 return self.run_job(job, restart=False)
@@ -304,7 +388,8 @@ class Worker:
         coq_serapy.admit_proof(self.coq, job_lemma, ending_command)
 
         self.lemmas_encountered.append(job)
-        return SearchResult(search_status, solution)
+        return SearchResult(search_status, solution,
+                            time.time() - search_start_time)
 
 def get_lemma_declaration_from_name(coq: coq_serapy.SerapiInstance,
                                     lemma_name: str) -> str:
@@ -348,6 +433,7 @@ def attempt_search(args: argparse.Namespace,
         unnamed_goal_number += 1
         lemma_name = f"Obligation{unnamed_goal_number}"
 
+    predictor.clear_caches()
     if args.max_search_time_per_lemma:
         timer = threading.Timer(args.max_search_time_per_lemma, _thread.interrupt_main)
         timer.start()